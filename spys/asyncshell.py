@@ -0,0 +1,368 @@
+"""
+Event-driven variant of SPyShell. The REPL runs as a task on a small
+select()-based event loop, so a slow command no longer freezes the prompt
+or the other output endpoints.
+
+Coroutine commands are generator functions decorated with @coroutine. They
+yield to wait on Futures, other coroutines, sleep() or blocking calls
+wrapped in inthread(), and hand back their result with `raise Return(value)`:
+
+    @asyncshell.coroutine
+    def fetch(url):
+        page = yield asyncshell.inthread(urllib.urlopen, url)
+        raise asyncshell.Return("%s bytes" % len(page.read()))
+
+Under AsyncShell several of these can be in flight at once, each result is
+routed through SPyIO.output when it completes. Under a plain SPyShell the
+same command simply runs to completion on a private loop. Input endpoints
+may return a Future instead of a string.
+"""
+import collections, errno, functools, heapq, os, select, sys, threading, time
+import spys
+
+class Return(Exception):
+    """ Raised by a coroutine to return a value """
+    def __init__(self, value=None):
+        Exception.__init__(self, value)
+        self.value = value
+
+
+class sleep(object):
+    """ Yielded by a coroutine to suspend it for a number of seconds """
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+
+class inthread(object):
+    """ Yielded by a coroutine to run a blocking call on a helper thread """
+    def __init__(self, fn, *args, **kwargs):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+
+
+def coroutine(fn):
+    """
+    Marks a generator function as a coroutine command. Calling the result
+    directly runs the coroutine to completion on a private event loop, so
+    coroutine commands keep working in synchronous shells.
+    """
+    @functools.wraps(fn)
+    def run(*args, **kwargs):
+        loop = EventLoop()
+        try:
+            return loop.run(fn(*args, **kwargs))
+        finally:
+            loop.close()
+    run.__wrapped__ = fn
+    run.coroutine = True
+    return run
+
+
+class Future(object):
+    """ Result of an operation that has not necessarily completed yet """
+    def __init__(self):
+        self.done = False
+        self.result = None
+        self.excinfo = None
+        self.callbacks = []
+
+    def setresult(self, result):
+        self.result = result
+        self.finish()
+
+    def setexception(self, excinfo):
+        self.excinfo = excinfo
+        self.finish()
+
+    def finish(self):
+        self.done = True
+        callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def adddonecallback(self, callback):
+        if self.done:
+            callback(self)
+        else:
+            self.callbacks.append(callback)
+
+    def get(self):
+        if self.excinfo:
+            raise self.excinfo[0], self.excinfo[1], self.excinfo[2]
+        return self.result
+
+
+class Task(Future):
+    """ Future driven by stepping a generator coroutine on an event loop """
+    def __init__(self, loop, gen):
+        super(Task, self).__init__()
+        self.loop = loop
+        self.gen = gen
+        loop.callsoon(self.step)
+
+    def step(self, value=None, excinfo=None):
+        try:
+            if excinfo:
+                yielded = self.gen.throw(*excinfo)
+            else:
+                yielded = self.gen.send(value)
+        except StopIteration:
+            self.setresult(None)
+        except Return, r:
+            self.setresult(r.value)
+        except Exception:
+            self.setexception(sys.exc_info())
+        else:
+            self.loop.wrap(yielded).adddonecallback(self.wakeup)
+
+    def wakeup(self, future):
+        self.loop.callsoon(self.step, future.result, future.excinfo)
+
+
+class EventLoop(object):
+    """
+    Minimal select()-based event loop: a ready queue, timers, file
+    descriptor readers and writers, and a self-pipe so other threads can
+    wake it.
+    """
+    def __init__(self):
+        self.ready = collections.deque()
+        self.timers = []
+        self.readers = {}
+        self.writers = {}
+        self.sequence = 0
+        self.lock = threading.Lock()
+        (self.wakefd, self.notifyfd) = os.pipe()
+        self.addreader(self.wakefd, lambda: os.read(self.wakefd, 4096))
+
+    def close(self):
+        self.removereader(self.wakefd)
+        os.close(self.wakefd)
+        os.close(self.notifyfd)
+
+    def callsoon(self, fn, *args):
+        self.ready.append((fn, args))
+
+    def callthreadsafe(self, fn, *args):
+        with self.lock:
+            self.ready.append((fn, args))
+        os.write(self.notifyfd, "x")
+
+    def calllater(self, seconds, fn, *args):
+        self.sequence += 1
+        heapq.heappush(self.timers, (time.time() + seconds, self.sequence, fn, args))
+
+    def addreader(self, fd, callback):
+        self.readers[fd] = callback
+
+    def removereader(self, fd):
+        self.readers.pop(fd, None)
+
+    def addwriter(self, fd, callback):
+        self.writers[fd] = callback
+
+    def removewriter(self, fd):
+        self.writers.pop(fd, None)
+
+    def spawn(self, gen):
+        return Task(self, gen)
+
+    def wrap(self, yielded):
+        """ Converts anything a coroutine may yield into a Future """
+        if isinstance(yielded, Future):
+            return yielded
+        future = Future()
+        if yielded is None:
+            self.callsoon(future.setresult, None)
+        elif isinstance(yielded, sleep):
+            self.calllater(yielded.seconds, future.setresult, None)
+        elif isinstance(yielded, inthread):
+            return self.runinthread(yielded.fn, *yielded.args, **yielded.kwargs)
+        elif hasattr(yielded, 'send') and hasattr(yielded, 'throw'):
+            return self.spawn(yielded)
+        else:
+            future.setexception((TypeError, TypeError("Cannot wait on %r" % (yielded,)), None))
+        return future
+
+    def runinthread(self, fn, *args, **kwargs):
+        """ Runs a blocking call on a helper thread, returning a Future """
+        future = Future()
+        def worker():
+            try:
+                result = fn(*args, **kwargs)
+            except Exception:
+                self.callthreadsafe(future.setexception, sys.exc_info())
+            else:
+                self.callthreadsafe(future.setresult, result)
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+        return future
+
+    def runonce(self):
+        if self.ready:
+            timeout = 0
+        elif self.timers:
+            timeout = max(0, self.timers[0][0] - time.time())
+        else:
+            timeout = None
+        try:
+            (readable, writable, failed) = select.select(list(self.readers), list(self.writers), [], timeout)
+        except select.error, e:
+            if e.args[0] != errno.EINTR:
+                raise
+            (readable, writable) = ([], [])
+        for fd in readable:
+            if fd in self.readers:
+                self.readers[fd]()
+        for fd in writable:
+            if fd in self.writers:
+                self.writers[fd]()
+        now = time.time()
+        while self.timers and self.timers[0][0] <= now:
+            (when, sequence, fn, args) = heapq.heappop(self.timers)
+            self.ready.append((fn, args))
+        with self.lock:
+            batch = list(self.ready)
+            self.ready.clear()
+        for (fn, args) in batch:
+            fn(*args)
+
+    def run(self, gen=None, until=None):
+        """
+        Runs the loop until the coroutine gen completes, returning its
+        result, or until the until() predicate becomes true.
+        """
+        task = gen is not None and self.spawn(gen)
+        while True:
+            if task and task.done:
+                return task.get()
+            if until and until():
+                return None
+            self.runonce()
+
+
+class LineReader(object):
+    """ Awaitable line input from a file descriptor """
+    def __init__(self, loop, fd):
+        self.loop = loop
+        self.fd = fd
+        self.buffer = ""
+        self.lines = collections.deque()
+        self.waiting = collections.deque()
+        self.eof = False
+        loop.addreader(fd, self.onreadable)
+
+    def onreadable(self):
+        try:
+            data = os.read(self.fd, 4096)
+        except OSError, e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            data = "" # a reset connection reads as end of input
+        if not data:
+            self.eof = True
+            self.loop.removereader(self.fd)
+            if self.buffer:
+                self.lines.append(self.buffer)
+                self.buffer = ""
+        else:
+            self.buffer += data
+            while "\n" in self.buffer:
+                (line, self.buffer) = self.buffer.split("\n", 1)
+                self.lines.append(line)
+        while self.waiting and (self.lines or self.eof):
+            self.waiting.popleft().setresult(self.lines.popleft() if self.lines else None)
+
+    def readline(self):
+        """ Future for the next line, None at end of input """
+        future = Future()
+        if self.lines:
+            future.setresult(self.lines.popleft())
+        elif self.eof:
+            future.setresult(None)
+        else:
+            self.waiting.append(future)
+        return future
+
+
+class AsyncShell(spys.SPyShell):
+    """
+    SPyShell whose REPL runs on an EventLoop. Coroutine commands are started
+    as tasks and the prompt returns immediately; their results are passed
+    to output() as they complete. Synchronous commands run exactly as they
+    do in SPyShell.
+    """
+    def __init__(self, arg=None, loop=None, parent=None):
+        super(AsyncShell, self).__init__(self, parent=parent)
+        self.loop = loop or EventLoop()
+        self.tasks = set()
+        self.running = False
+        self.stdin = None
+        if self.callinginstance is self:
+            self.registerinput(0, self.asyncinput) # subshells keep their parent's input
+
+    def asyncinput(self, prompt=None):
+        """ Default input endpoint: prompt on stdout, Future for the next line of stdin """
+        if self.stdin is None:
+            self.stdin = LineReader(self.loop, sys.stdin.fileno())
+        if prompt:
+            sys.stdout.write(prompt)
+            sys.stdout.flush()
+        return self.stdin.readline()
+
+    def dispatch(self, args, input):
+        command = args and self.getcmd(args[0])
+        if command and getattr(command.fn, 'coroutine', False):
+            self.spawncommand(command, args)
+            return None
+        return super(AsyncShell, self).dispatch(args, input)
+
+    def spawncommand(self, command, args):
+        if command.instance:
+            gen = command.fn.__wrapped__(instance=self, *args[1:])
+        else:
+            gen = command.fn.__wrapped__(*args[1:])
+        task = self.loop.spawn(gen)
+        self.tasks.add(task)
+        def done(task):
+            self.tasks.discard(task)
+            try:
+                result = task.get()
+            except Exception, e:
+                self.error("Untrapped exception in '%s %s'" % (command.name, list(args[1:])), e)
+            else:
+                if result:
+                    self.output(result)
+            self.flush()
+        task.adddonecallback(done)
+        return task
+
+    def repl(self):
+        while self.running:
+            input = self.input(self.getprompt())
+            if isinstance(input, Future):
+                input = yield input
+            if input is None:
+                self.stop()
+                break
+            try:
+                self.evaluate(input)
+            except Exception, e:
+                self.error("Untrapped exception in read-eval-print", e)
+
+    def start(self):
+        """ Runs the REPL until exit, then waits for in-flight commands """
+        self.running = True
+        self.loop.spawn(self.repl())
+        self.loop.run(until=lambda: not self.running and not self.tasks)
+
+    def stop(self):
+        self.running = False
+        super(AsyncShell, self).stop()
+
+
+if __name__ == "__main__":
+    s = AsyncShell()
+    s.start()
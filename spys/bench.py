@@ -0,0 +1,489 @@
+"""
+Micro-benchmarks for the SPyS hot paths.
+
+Run all benchmarks, or only the named ones:
+    python bench.py [--save] [--baseline FILE] [--threshold PCT] [benchmark ...]
+Each benchmark prints one line per case, as operations per second. The
+results are then compared with the saved baseline (bench-baseline.json
+next to this file) and cases more than --threshold percent slower are
+flagged as regressions, with a non-zero exit status. --save records the
+results as the new baseline instead. Baselines are only comparable on
+the machine and Python version they were saved with.
+"""
+import inspect, json, os, platform, random, shlex, shutil, sys, tempfile, threading, time, types
+import spys
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench-baseline.json")
+RESULTS = {}    # "name/case" => ops/s
+
+def noop(*args):
+    return None
+
+def timed(fn, repeat=3):
+    """ Best wall-clock time of fn() over repeat runs """
+    best = None
+    for x in range(0, repeat):
+        start = time.time()
+        fn()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def report(name, case, ops, elapsed):
+    rate = ops / max(elapsed, 1e-9)
+    RESULTS["%s/%s" % (name, case)] = rate
+    print "%-12s %-24s %12.0f ops/s" % (name, case, rate)
+
+def quietshell(cls=spys.SPyShell):
+    """ Shell instance with output endpoints discarded """
+    shell = cls()
+    shell.registeroutput(0, noop)
+    shell.registeroutput("error", noop)
+    return shell
+
+def legacydispatch(commands, shell, line):
+    """ Per-line dispatch as handle() did it before the dispatch table """
+    args = shlex.split(line)
+    cmd, cmdargs = args[0], args[1:]
+    if cmd in commands.keys():
+        if type(commands[cmd]) == types.FunctionType and \
+        "instance" in inspect.getargspec(commands[cmd])[0]:
+            return commands[cmd](instance=shell, *cmdargs)
+        return commands[cmd](*cmdargs)
+
+def bench_dispatch(lines=20000):
+    for size in (10, 1000, 10000):
+        shell = quietshell()
+        commands = {}
+        for i in xrange(size):
+            shell.setcmd("cmd%d" % i, noop)
+            commands["cmd%d" % i] = noop
+        script = ["cmd%d a b" % (i % size) for i in xrange(lines)]
+
+        def run():
+            for line in script:
+                shell.handle(line)
+        report("dispatch", "%d commands" % size, lines, timed(run))
+        shell.metrics = spys.Metrics()
+        report("dispatch", "%d commands (metrics)" % size, lines, timed(run))
+        shell.metrics = None
+
+        def legacy():
+            for line in script:
+                legacydispatch(commands, shell, line)
+        report("dispatch", "%d commands (legacy)" % size, lines, timed(legacy))
+
+def bench_tokenize(lines=20000):
+    corpus = {
+        "plain": ["cmd%d arg%d another argument" % (i % 50, i) for i in xrange(lines)],
+        "quoted": ["cmd%d 'arg %d' \"another \\\"arg\\\"\"" % (i % 50, i) for i in xrange(lines)],
+    }
+    for (kind, script) in sorted(corpus.items()):
+        for (name, fn) in (("shlex", shlex.split), ("split", spys.split)):
+            def run():
+                for line in script:
+                    fn(line)
+            report("tokenize", "%s %s" % (kind, name), lines, timed(run))
+
+        # repeated sessions send a small set of distinct lines
+        repeated = [script[i % 50] for i in xrange(lines)]
+        shell = quietshell()
+        def cached():
+            for line in repeated:
+                shell.tokenize(line)
+        report("tokenize", "%s split+cache" % kind, lines, timed(cached))
+
+def bench_script(lines=20000):
+    workdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(workdir, "bench.script")
+        script = open(path, "w")
+        for i in xrange(lines):
+            script.write("cmd%d 'arg %d' \"another arg\"\n" % (i % 50, i))
+        script.close()
+        shell = quietshell()
+        shell.plancache = os.path.join(workdir, "plans")
+        for i in xrange(50):
+            shell.setcmd("cmd%d" % i, noop)
+
+        report("script", "line by line", lines, timed(lambda: shell.script(path, True)))
+        def cold():
+            shutil.rmtree(shell.plancache, True)
+            shell.runplan(path, True)
+        report("script", "plan (cold)", lines, timed(cold))
+        report("script", "plan (cached)", lines, timed(lambda: shell.runplan(path, True)))
+    finally:
+        shutil.rmtree(workdir, True)
+
+def legacyexecute(shell, cmdstr):
+    """ execute() as it was before the code cache, compiling every time """
+    exec cmdstr
+
+def bench_exec(lines=20000):
+    shell = quietshell()
+    shell.shared["total"] = 0
+    statement = "self.shared['total'] = self.shared['total'] + len([i * i for i in range(10)])"
+    def legacy():
+        for i in xrange(lines):
+            legacyexecute(shell, statement.replace("self.", "shell."))
+    report("exec", "compile every call", lines, timed(legacy))
+    def cached():
+        for i in xrange(lines):
+            shell.execute(statement)
+    report("exec", "code cache", lines, timed(cached))
+    def bind():
+        for i in xrange(lines):
+            shell.bindfn("square", "lambda x: int(x) ** 2")
+    report("exec", "bind (code cache)", lines, timed(bind))
+
+def convert(value):
+    # stands in for a pure converter or lookup doing real work
+    return ",".join("%x" % (int(value) * i) for i in xrange(50))
+
+def bench_memo(lines=20000):
+    script = ["convert %d" % (i % 100) for i in xrange(lines)]
+    for (case, memo) in (("plain", False), ("memoized", True)):
+        shell = quietshell()
+        shell.setcmd("convert", convert, memo=memo)
+        def run():
+            for line in script:
+                shell.handle(line)
+        report("memo", "100 distinct args %s" % case, lines, timed(run))
+
+def atdepth(depth, fn):
+    """ Calls fn() from depth nested frames """
+    if depth <= 0:
+        return fn()
+    return atdepth(depth - 1, fn)
+
+def bench_subshell(count=500):
+    parent = quietshell()
+    def legacy():
+        # what every implicit construction paid for before findcaller()
+        inspect.stack()
+        return spys.SPyShell(parent=parent)
+    for depth in (10, 100, 500):
+        for (case, make) in (("implicit", spys.SPyShell),
+                             ("spawn", parent.spawn),
+                             ("inspect.stack", legacy)):
+            def run():
+                for i in xrange(count):
+                    atdepth(depth, make)
+            report("subshell", "depth %d %s" % (depth, case), count, timed(run))
+
+class ListStack(object):
+    """ The list-backed FixedStack that RingBuffer replaced """
+    def __init__(self, size):
+        self.buffer = [None] * size
+
+    def append(self, value):
+        del(self.buffer[0])
+        self.buffer.append(value)
+
+    def pop(self):
+        self.buffer.insert(0, None)
+        return self.buffer.pop()
+
+def bench_history(ops=20000):
+    for size in (20, 1000, 100000):
+        for (case, cls) in (("ring", spys.RingBuffer), ("list", ListStack)):
+            stack = cls(size)
+            def run():
+                for i in xrange(ops):
+                    stack.append(i)
+                    if i % 4 == 0:
+                        stack.pop()
+            report("history", "%d entries %s" % (size, case), ops, timed(run))
+
+def bench_histfile(lookups=1000):
+    import history
+    workdir = tempfile.mkdtemp()
+    try:
+        for size in (1000, 100000, 1000000):
+            path = os.path.join(workdir, "history.%d" % size)
+            log = open(path, "w")
+            for i in xrange(size):
+                log.write("cmd%d arg %d\n" % (i % 50, i))
+            log.close()
+            def startup():
+                store = history.HistoryStore(path)
+                store[0]
+                store.close()
+            report("histfile", "%d lines open+[0]" % size, 1, timed(startup))
+            store = history.HistoryStore(path)
+            def navigate():
+                for i in xrange(lookups):
+                    store[i]
+            report("histfile", "%d lines up-arrow" % size, lookups, timed(navigate))
+            report("histfile", "%d lines prefix" % size, 1,
+                   timed(lambda: store.search("cmd7 ", prefix=True, limit=10)))
+            store.close()
+    finally:
+        shutil.rmtree(workdir, True)
+
+def bench_plugins(plugins=12):
+    workdir = tempfile.mkdtemp()
+    sys.path.insert(0, workdir)
+    try:
+        names = ["benchplugin%d" % i for i in range(plugins)]
+        for name in names:
+            source = open(os.path.join(workdir, name + ".py"), "w")
+            # stands in for a plugin with heavy imports or setup at import time
+            source.write("table = dict((i, str(i) * 8) for i in xrange(50000))\n"
+                         "def lookup(key):\n    return table[int(key)]\n"
+                         "def spys_exports():\n    return [(__name__, '%s', lookup)]\n" % name)
+            source.close()
+            open(os.path.join(workdir, name + ".manifest"), "w").write(name + "\n")
+        shell = quietshell()
+        for (case, lazy) in (("eager", False), ("lazy", True)):
+            def startup():
+                for name in names:
+                    sys.modules.pop(name, None)
+                for name in names:
+                    shell.loadmodule(name, lazy=lazy)
+            report("plugins", "%d plugins %s" % (plugins, case), 1, timed(startup))
+    finally:
+        sys.path.remove(workdir)
+        shutil.rmtree(workdir, True)
+
+def bench_output(messages=20000):
+    (fd, path) = tempfile.mkstemp()
+    log = os.fdopen(fd, "w")
+    screen = [" " * 80] * 24
+    def sink(data=None):
+        # redraws a whole 80x25 screen per call, like the cursesdemo windows
+        log.write("\n".join(screen + [str(data)[-80:]]) + "\n")
+        log.flush()
+    try:
+        for (case, options) in (("unbuffered", {}),
+                                ("buffered 64", dict(buffered=True, size=64)),
+                                ("buffered 1024", dict(buffered=True, size=1024, interval=1.0))):
+            shell = quietshell()
+            shell.registeroutput(0, sink, **options)
+            def run():
+                for i in xrange(messages):
+                    shell.output(i)
+                shell.flush()
+            report("output", case, messages, timed(run))
+
+        # screen plus a warnings-only log: formatted once, only when wanted
+        shell = quietshell()
+        shell.registeroutput(0, spys.TeeEndpoint())
+        shell.addsink(0, sink, level=spys.INFO)
+        shell.addsink(0, sink, level=spys.WARNING)
+        def tee():
+            for i in xrange(messages):
+                shell.output(spys.Message("message %d", i), level=spys.DEBUG)
+        report("output", "tee, all filtered", messages, timed(tee))
+    finally:
+        log.close()
+        os.remove(path)
+
+def bench_server(sessions=(1, 50, 200), commands=200):
+    import multiprocessing, server
+    workdir = tempfile.mkdtemp()
+    path = os.path.join(workdir, "spys.sock")
+    instance = server.SPyServer()
+    instance.listen(path)
+    process = multiprocessing.Process(target=instance.serve)
+    process.start()
+    try:
+        for count in sessions:
+            (sessionrate, commandrate) = server.loadtest(path, count, commands)
+            report("server", "%d sessions connect" % count, sessionrate, 1.0)
+            report("server", "%d sessions commands" % count, commandrate, 1.0)
+    finally:
+        process.terminate()
+        process.join()
+        shutil.rmtree(workdir, True)
+
+class LockedDict(dict):
+    """ Plain dict behind one global lock, the obvious alternative to SharedState """
+    def __init__(self):
+        self.lock = threading.Lock()
+
+    def modify(self, key, fn, default=None):
+        with self.lock:
+            value = self[key] = fn(self.get(key, default))
+            return value
+
+def increment(value):
+    return value + 1
+
+def bench_shared(ops=20000, keys=64):
+    for threads in (1, 4, 16):
+        for (case, make) in (("striped", spys.SharedState), ("global lock", LockedDict)):
+            def run():
+                state = make()
+                def worker(seed):
+                    rand = random.Random(seed)
+                    for i in xrange(ops // threads):
+                        state.modify(rand.randrange(keys), increment, 0)
+                        state.get(rand.randrange(keys))
+                workers = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+                for thread in workers:
+                    thread.start()
+                for thread in workers:
+                    thread.join()
+                if sum(state.values()) != ops // threads * threads:
+                    raise AssertionError("%s lost updates under %d threads" % (case, threads))
+            report("shared", "%d threads %s" % (threads, case), ops, timed(run))
+
+def payloadsize(args):
+    return len(args[1])
+
+def attachedsize(args):
+    return len(args[0].view(args[1]))
+
+def bench_sharedmem(tasks=200, size=1 << 20):
+    import multiprocessing
+    payload = os.urandom(size)
+    state = spys.SharedMemoryState()
+    try:
+        state["payload"] = payload
+        local = spys.SharedState({"payload": payload})
+        for (case, store) in (("SharedState", local), ("SharedMemoryState", state)):
+            def reads():
+                for i in xrange(tasks * 100):
+                    store.get("payload")
+            report("sharedmem", "get %s" % case, tasks * 100, timed(reads))
+        pool = multiprocessing.Pool(4)
+        try:
+            report("sharedmem", "pickled per task", tasks,
+                   timed(lambda: pool.map(payloadsize, [(None, payload)] * tasks)))
+            report("sharedmem", "attached segment", tasks,
+                   timed(lambda: pool.map(attachedsize, [(state, "payload")] * tasks)))
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        state.unlink()
+        state.close()
+
+def bench_isolated(calls=2000):
+    workdir = tempfile.mkdtemp()
+    sys.path.insert(0, workdir) # inherited by the worker processes
+    try:
+        # only plugin exports can be isolated
+        open(os.path.join(workdir, "benchisolated.py"), "w").write(
+            "def echo(*args):\n    return ' '.join(args)\n"
+            "def spys_exports():\n    return [(__name__, 'echo', echo)]\n")
+        for (case, isolate, maxcalls) in (("in-process", False, 0), ("isolated", True, 100000),
+                                          ("recycled every 100", True, 100)):
+            shell = quietshell()
+            shell.loadmodule("benchisolated", lazy=False)
+            if isolate:
+                shell.workercalls = maxcalls
+                shell.isolate("echo")
+            def run():
+                for i in xrange(calls):
+                    shell.handle("echo x")
+            try:
+                report("isolated", case, calls, timed(run))
+            finally:
+                shell.stop()
+    finally:
+        sys.path.remove(workdir)
+        shutil.rmtree(workdir, True)
+
+def bench_editbuffer(edits=2000):
+    import editable
+    for size in (100, 10000, 1000000):
+        text = "x" * size
+        buffer = editable.EditBuffer(text, "> ", 80)
+        buffer.moveabs(size // 2)
+        def typing():
+            for i in xrange(edits):
+                buffer.insert("a")
+                buffer.backspace()
+        report("editbuffer", "%d chars insert" % size, edits * 2, timed(typing))
+        def render():
+            for i in xrange(edits):
+                buffer.render()
+        report("editbuffer", "%d chars render" % size, edits, timed(render))
+
+def bench_calc(lines=5000):
+    import calc
+    class QuietCalc(calc.Calc):
+        def start(self):
+            pass # no REPL, lines are fed to default() directly
+    shell = quietshell(QuietCalc)
+    for (case, line) in (("short", "1 1 2 3 5 8 + - * / ="),
+                         ("long", " ".join(["2 3 *"] * 20 + ["+"] * 19 + ["="])),
+                         ("stack dump", "1 2 3 4 5 6 7 8 $ x")):
+        def run():
+            for i in xrange(lines):
+                list(spys.records(shell.default(line)))
+                shell.stack = []
+        report("calc", case, lines, timed(run))
+
+def environment():
+    return {"python": platform.python_version(), "implementation": platform.python_implementation(),
+            "machine": platform.machine(), "system": platform.system()}
+
+def compare(baseline, results, threshold):
+    """ Prints cases slower than baseline by more than threshold percent, returns how many """
+    if baseline.get("environment") != environment():
+        print "warning: baseline was saved with %s, this is %s" % (baseline.get("environment"), environment())
+    regressions = 0
+    for key in sorted(results):
+        if key not in baseline["results"]:
+            continue
+        change = 100.0 * (results[key] / baseline["results"][key] - 1)
+        if change < -threshold:
+            regressions += 1
+            print "REGRESSION %-37s %12.0f -> %12.0f ops/s (%+.1f%%)" % (
+                  key, baseline["results"][key], results[key], change)
+    compared = len([key for key in results if key in baseline["results"]])
+    print "%d of %d cases compared with the baseline regressed by more than %g%%" % (
+          regressions, compared, threshold)
+    return regressions
+
+def save(filename, results):
+    """ Stores results as the baseline, keeping saved cases that were not run """
+    baseline = {"results": {}}
+    if os.path.exists(filename):
+        baseline = json.load(open(filename))
+    baseline["environment"] = environment()
+    baseline["results"].update(results)
+    with open(filename, "w") as out:
+        json.dump(baseline, out, indent=1, sort_keys=True)
+        out.write("\n")
+
+BENCHMARKS = [
+    ("dispatch", bench_dispatch),
+    ("tokenize", bench_tokenize),
+    ("script", bench_script),
+    ("exec", bench_exec),
+    ("memo", bench_memo),
+    ("subshell", bench_subshell),
+    ("history", bench_history),
+    ("histfile", bench_histfile),
+    ("plugins", bench_plugins),
+    ("output", bench_output),
+    ("editbuffer", bench_editbuffer),
+    ("calc", bench_calc),
+    ("server", bench_server),
+    ("shared", bench_shared),
+    ("sharedmem", bench_sharedmem),
+    ("isolated", bench_isolated),
+]
+
+if __name__ == "__main__":
+    import optparse
+    parser = optparse.OptionParser(usage="%prog [--save] [--baseline FILE] [--threshold PCT] [benchmark ...]")
+    parser.add_option("--baseline", default=BASELINE, help="baseline file (default: %default)")
+    parser.add_option("--save", action="store_true", help="save the results as the baseline")
+    parser.add_option("--threshold", type="float", default=20.0,
+                      help="percent slowdown flagged as a regression (default: %default)")
+    (options, wanted) = parser.parse_args()
+    for (name, fn) in BENCHMARKS:
+        if not wanted or name in wanted:
+            fn()
+    if options.save:
+        save(options.baseline, RESULTS)
+        print "saved %d cases to %s" % (len(RESULTS), options.baseline)
+    elif os.path.exists(options.baseline):
+        if compare(json.load(open(options.baseline)), RESULTS, options.threshold):
+            sys.exit(1)
@@ -21,12 +21,27 @@ class Calc(spys.SPyShell):
     rpn> 1 1 2 3 5 8 + - * / =
     0: -0.05
     """
-    def __init__(self, arg=None):
-        super(Calc, self).__init__(self)
+    def __init__(self, arg=None, parent=None):
+        super(Calc, self).__init__(self, parent=parent)
         self.stack = []
         self.setprompt("rpn> ")
         self.start()
     
+    def iterstack(self, limit=None):
+        """
+        Pretty-print RPN stack, with indexes, one line at a time. Works
+        from a snapshot, so later operators don't change what is printed.
+        """
+        stack = list(self.stack)
+        def lines():
+            if not stack:
+                yield "Empty stack"
+            for (index, item) in enumerate(reversed(stack)):
+                if limit and (index >= limit):
+                    break
+                yield "%s: %s" % (index, item)
+        return lines()
+
     def dumpstack(self, limit=None):
         """Pretty-print RPN stack, with indexes."""
         output = []
@@ -64,7 +79,7 @@ class Calc(spys.SPyShell):
                 except Exception, e:
                     self.error("Bad mojo", e)
             elif word == '$':
-                buffer.append(self.dumpstack())
+                buffer.append(self.iterstack())
             elif word == '=':
                 buffer.append(self.dumpstack(1))
             else:
@@ -72,8 +87,18 @@ class Calc(spys.SPyShell):
                     self.stack.append(float(word))
                 except ValueError:
                     return "Input must be an operator or a parseable number"
+        if any(spys.isstream(item) for item in buffer):
+            return self.chunks(buffer)
         return "\n\n".join(buffer)
 
+    def chunks(self, buffer):
+        """Streams buffered messages, blank line separated, as the REPL outputs them."""
+        for (index, item) in enumerate(buffer):
+            if index:
+                yield ""
+            for chunk in spys.records(item):
+                yield chunk
+
 def ponies():
     """
     Plain functions can be dynaloaded as well, with one caveat:
@@ -99,6 +124,9 @@ def spys_exports():
     SPyS environment, and finally the callable object itself. When @load <package> is
     called, the presence of this function will indicate this package is a SPyS plugin
     and will allow the parent to load and map the exported callables into itself.
+
+    The same command names are listed in calc.manifest, which lets @load
+    bind them lazily and defer importing this module until first use.
     """
     return [(__name__, "calc", Calc), 
             (__name__, "ponies", ponies),
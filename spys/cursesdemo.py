@@ -1,5 +1,6 @@
 import curses
 import editable
+import history
 import spys
 import sys
 """
@@ -16,7 +17,9 @@ wstatus = curses.newwin(1, wwidth, 0, 0)
 wmain = curses.newwin(wheight - 3, wwidth, 1, 0)
 winfo = winp = curses.newwin(1, wwidth, wheight - 2, 0)
 winp = curses.newwin(1, wwidth, wheight - 1, 0)
-c = editable.EditableWindow(winp)
+# up/down in the input window walk the same history the shell saves to
+inputhistory = history.HistoryStore("~/.spys_history")
+c = editable.EditableWindow(winp, history=inputhistory)
 winp.keypad(True)
 
 curses.init_pair(1, curses.COLOR_WHITE, curses.COLOR_BLUE)
@@ -83,7 +86,7 @@ def setinfo(string, instance):
 def getpass(string, instance):
     return instance.input("Password: ", "masked")
 
-s = spys.SPyShell()
+s = spys.SPyShell(histfile=inputhistory)
 
 # steal stdX so print/read get redirected to curses
 class ProxyStdIO(object):
@@ -100,9 +103,11 @@ sys.stderr = proxy
 
 s.registerinput(0, c.input)
 s.registerinput("masked", endp_maskedinput)
-s.registeroutput(0, endp_wmain)
-s.registeroutput(1, endp_wstatus)
-s.registeroutput("info", endp_winfo)
+# every endpoint redraws the whole screen, so coalesce bursts of output;
+# the one-line windows only ever need to show the newest message
+s.registeroutput(0, endp_wmain, buffered=True)
+s.registeroutput(1, endp_wstatus, buffered=True, latest=True)
+s.registeroutput("info", endp_winfo, buffered=True, latest=True)
 
 s.output("main window (endpoint 0)", 0)
 s.output("status window (endpoint 1)", 1)
@@ -141,11 +141,18 @@ class EditableWindow(object):
     """
     Provides line editing and command buffer functionality for curses windows
     with a subset of emacs key bindings. Untested with multi-line windows.
+
+    Up/down navigate a newest-first input history. By default this is kept
+    in memory; pass a history.HistoryStore as history to navigate a
+    persistent one that the shell records into instead.
     """
-    def __init__(self, window):
+    def __init__(self, window, history=None):
         self.window = window
         self.inbuf = []
-        self.linebuf = []
+        self.record = history is None
+        if history is None:
+            history = []
+        self.linebuf = history
         self.tempbuf = ""
         self.prompt = ""
         self.curline = 0
@@ -163,8 +170,11 @@ class EditableWindow(object):
         """ Pull previous input from the buffer """
         try:
             self.inbuf.load(self.linebuf[self.curline])
-            if self.curline < len(self.linebuf) - 1:
+            try:
+                self.linebuf[self.curline + 1]
                 self.curline += 1
+            except IndexError:
+                pass
         except IndexError:
             try:
                 self.inbuf.load(self.linebuf[-1])
@@ -231,7 +241,7 @@ class EditableWindow(object):
             if echo:
                 self.sync()
         # don't push masked input into command buffer
-        if echo:
+        if echo and self.record:
             if len(self.inbuf) > 0:
                 self.linebuf.insert(0, str(self.inbuf))
 
@@ -0,0 +1,147 @@
+"""
+Persistent command history for SPyS shells and EditableWindow.
+"""
+import mmap, os, re
+
+_ESCAPE = re.compile(r'[\\\n]')
+_UNESCAPE = re.compile(r'\\(.)')
+
+def escape(entry):
+    return _ESCAPE.sub(lambda m: m.group(0) == "\n" and "\\n" or "\\\\", entry)
+
+def unescape(line):
+    return _UNESCAPE.sub(lambda m: m.group(1) == "n" and "\n" or m.group(1), line)
+
+class HistoryStore(object):
+    """
+    Append-only history log with one entry per line, read through mmap.
+
+    Entries are indexed newest first, like EditableWindow.linebuf, and
+    line offsets are only indexed as far back as has been asked for, so
+    opening a store takes the same time whether the log holds a hundred
+    lines or millions. Searches scan the mapped log backwards at C speed
+    and stop as soon as they have enough matches.
+    """
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+        self.opened = False
+        self.map = None
+        self.spans = []     # (start, end) of logged entries, newest first
+        self.scanned = 0    # end of the newest entry not yet in spans, -1 when done
+        self.recent = []    # entries appended since the log was mapped, oldest first
+        self.log = None
+
+    def open(self):
+        """ Maps the log; done on first use rather than at startup """
+        if self.opened:
+            return
+        self.opened = True
+        self.scanned = -1
+        try:
+            file = open(self.path, "rb")
+        except IOError:
+            return
+        try:
+            size = os.fstat(file.fileno()).st_size
+            if size:
+                self.map = mmap.mmap(file.fileno(), size, access=mmap.ACCESS_READ)
+                self.scanned = size - 1 if self.map[size - 1] == "\n" else size
+        finally:
+            file.close()
+
+    def close(self):
+        if self.log:
+            self.log.close()
+            self.log = None
+        if self.map:
+            self.map.close()
+            self.map = None
+
+    def append(self, entry):
+        """ Adds an entry to the log; empty entries are ignored """
+        if not entry:
+            return
+        self.open()
+        if self.log is None:
+            self.log = open(self.path, "ab")
+        self.log.write(escape(entry) + "\n")
+        self.log.flush()
+        self.recent.append(entry)
+
+    def insert(self, index, entry):
+        """ list.insert(0, entry) compatibility for EditableWindow """
+        if index != 0:
+            raise ValueError("history entries can only be added at the front")
+        self.append(entry)
+
+    def __getitem__(self, index):
+        self.open()
+        if index < 0:
+            raise IndexError("history index must be positive")
+        if index < len(self.recent):
+            return self.recent[-1 - index]
+        index -= len(self.recent)
+        while index >= len(self.spans) and self.scanned >= 0:
+            start = self.map.rfind("\n", 0, self.scanned) + 1
+            self.spans.append((start, self.scanned))
+            self.scanned = start - 1
+        if index >= len(self.spans):
+            raise IndexError("history index out of range")
+        (start, end) = self.spans[index]
+        return unescape(self.map[start:end])
+
+    def __iter__(self):
+        """ Entries newest first """
+        index = 0
+        while True:
+            try:
+                yield self[index]
+            except IndexError:
+                return
+            index += 1
+
+    def search(self, text, prefix=False, limit=None):
+        """
+        Returns up to limit distinct entries containing text (or starting
+        with it, if prefix is set), newest first.
+        """
+        self.open()
+        matches = []
+        seen = set()
+        def found(entry):
+            if entry not in seen:
+                seen.add(entry)
+                matches.append(entry)
+            return limit and len(matches) >= limit
+
+        for entry in reversed(self.recent):
+            if (entry.startswith(text) if prefix else text in entry) and found(entry):
+                return matches
+        if not self.map:
+            return matches
+
+        needle = escape(text)
+        if prefix:
+            needle = "\n" + needle
+        pos = len(self.map)
+        while pos > 0:
+            hit = self.map.rfind(needle, 0, pos)
+            if hit < 0:
+                if prefix and self.map[:len(needle) - 1] == needle[1:]:
+                    # the first entry has no newline in front of it
+                    hit = -1
+                else:
+                    break
+            if prefix:
+                start = hit + 1
+            else:
+                start = self.map.rfind("\n", 0, hit) + 1
+            end = self.map.find("\n", start)
+            if end < 0:
+                end = len(self.map)
+            entry = unescape(self.map[start:end])
+            # the log is escaped, so a hit can fall inside an escape sequence
+            if (entry.startswith(text) if prefix else text in entry) and found(entry):
+                break
+            pos = start - 1 if prefix else start
+        return matches
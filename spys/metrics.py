@@ -0,0 +1,101 @@
+"""
+Per-command call counts, error counts and latency histograms for SPyS
+shells. Collection is off until a shell's metrics attribute is set, see
+the stats command.
+"""
+import json, math, threading
+
+RESOLUTION = 4      # histogram buckets per doubling of latency
+SMALLEST = 1e-7     # latencies are clamped to at least 0.1us
+
+def bucket(seconds):
+    return int(math.floor(math.log(max(seconds, SMALLEST), 2) * RESOLUTION))
+
+def upperbound(index):
+    return 2 ** ((index + 1) / float(RESOLUTION))
+
+
+class CommandStats(object):
+    """
+    Counters for one command. Latencies go into log-scale buckets, so
+    percentiles are accurate to within one bucket (about 19%) whatever
+    the number of calls.
+    """
+    __slots__ = ('calls', 'errors', 'total', 'max', 'buckets')
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = {}
+
+    def add(self, elapsed, failed=False):
+        self.calls += 1
+        if failed:
+            self.errors += 1
+        self.total += elapsed
+        if elapsed > self.max:
+            self.max = elapsed
+        index = bucket(elapsed)
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+
+    def percentile(self, fraction):
+        """ Upper bound of the bucket holding the given fraction of calls """
+        wanted = fraction * self.calls
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= wanted:
+                return min(upperbound(index), self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "total": self.total,
+            "mean": self.total / max(self.calls, 1),
+            "p50": self.percentile(0.5),
+            "p95": self.percentile(0.95),
+            "p99": self.percentile(0.99),
+            "max": self.max,
+        }
+
+
+class Metrics(object):
+    """
+    CommandStats by command name, shared by a shell and its subshells.
+    Background jobs record from their own threads, so updates are made
+    under a lock.
+    """
+    def __init__(self):
+        self.commands = {}
+        self.lock = threading.Lock()
+
+    def record(self, name, elapsed, failed=False):
+        with self.lock:
+            stats = self.commands.get(name)
+            if stats is None:
+                stats = self.commands[name] = CommandStats()
+            stats.add(elapsed, failed)
+
+    def summary(self):
+        """ {command: summary dict}, latencies in seconds """
+        with self.lock:
+            return dict((name, stats.summary()) for (name, stats) in self.commands.items())
+
+    def dump(self):
+        """ Machine-readable summary, as JSON """
+        return json.dumps(self.summary(), sort_keys=True)
+
+    def table(self):
+        """ Human-readable summary, slowest commands (by total time) first """
+        lines = ["%-16s %8s %6s %9s %9s %9s %9s %9s" % (
+                 "command", "calls", "errors", "mean ms", "p50 ms", "p95 ms", "p99 ms", "max ms")]
+        rows = sorted(self.summary().items(), key=lambda item: -item[1]["total"])
+        for (name, row) in rows:
+            lines.append("%-16s %8d %6d %9.3f %9.3f %9.3f %9.3f %9.3f" % (
+                         name, row["calls"], row["errors"], 1000 * row["mean"], 1000 * row["p50"],
+                         1000 * row["p95"], 1000 * row["p99"], 1000 * row["max"]))
+        return "\n".join(lines)
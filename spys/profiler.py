@@ -0,0 +1,71 @@
+"""
+Sampling profiler for the SPyS profile command. cProfile traces every
+call, which slows long runs down several times over; the Sampler instead
+looks at the profiled thread's stack every few milliseconds from a
+helper thread, so it costs little however long the command runs.
+"""
+import collections, os, sys, thread, threading, time
+
+def label(code):
+    return "%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+
+class Sampler(object):
+    """
+    Counts the stacks seen while runcall() runs a function. hotspots()
+    reports the functions seen most often, writefolded() writes the
+    stacks in the folded format read by flamegraph.pl and speedscope.
+    """
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.samples = 0
+
+    def runcall(self, fn, *args, **kwargs):
+        target = thread.get_ident()
+        state = {"running": True}
+        def sample():
+            while state["running"]:
+                time.sleep(self.interval)
+                frame = sys._current_frames().get(target)
+                stack = []
+                while frame is not None and frame.f_code is not CALL:
+                    stack.append(label(frame.f_code))
+                    frame = frame.f_back
+                if frame is not None and stack:
+                    self.stacks[tuple(reversed(stack))] += 1
+                    self.samples += 1
+        sampler = threading.Thread(target=sample)
+        sampler.daemon = True
+        sampler.start()
+        try:
+            return self.call(fn, args, kwargs)
+        finally:
+            state["running"] = False
+            sampler.join()
+
+    def call(self, fn, args, kwargs):
+        """ Frame marking the bottom of the stacks that are sampled """
+        return fn(*args, **kwargs)
+
+    def hotspots(self, limit=20):
+        """ Functions by samples spent in them (self) and under them (total) """
+        selftime = collections.Counter()
+        totaltime = collections.Counter()
+        for (stack, count) in self.stacks.iteritems():
+            selftime[stack[-1]] += count
+            for function in set(stack):
+                totaltime[function] += count
+        lines = ["%d samples, %.0fms apart" % (self.samples, 1000 * self.interval),
+                 "%7s %7s  %s" % ("self%", "total%", "function")]
+        for (function, count) in selftime.most_common(limit):
+            lines.append("%7.1f %7.1f  %s" % (100.0 * count / self.samples,
+                         100.0 * totaltime[function] / self.samples, function))
+        return "\n".join(lines)
+
+    def writefolded(self, filename):
+        with open(filename, "w") as folded:
+            for (stack, count) in sorted(self.stacks.iteritems()):
+                folded.write("%s %d\n" % (";".join(stack), count))
+
+CALL = Sampler.call.__func__.__code__
@@ -0,0 +1,331 @@
+"""
+Multi-session server mode for SPyS. One long-lived process keeps its
+plugins loaded and serves any number of sessions over a Unix-domain or
+localhost TCP socket:
+
+    python server.py [--unix PATH | --host HOST --port N] [-l module ...]
+    nc -U PATH   (or: nc localhost N)
+
+Every session is an AsyncShell running on the server's single EventLoop,
+with its own prompt, history and I/O endpoints, layered over the server
+shell's command table and sharing its shared dict. Commands bound or
+loaded in one session are visible in all of them. A synchronous command
+holds up every session while it runs, so slow commands should be
+coroutines (see asyncshell). Subshells, such as calc, run their REPL on a
+thread of their own, so one waiting for input only holds up its own
+session. Other commands that read input themselves run a nested event
+loop while they wait, and only return once every such wait started
+after theirs, in any session, has ended.
+
+    python server.py --loadtest [--unix PATH | --port N] [--sessions N] [--commands N]
+
+connects many clients at once and reports sessions and commands per second.
+"""
+import errno, os, select, socket, thread, threading, time
+import asyncshell, spys
+
+class Disconnected(BaseException):
+    """ Unwinds a synchronous subshell whose session's client went away """
+
+
+class Session(asyncshell.AsyncShell):
+    """ One client connection, run as an AsyncShell on the server's loop """
+    def __init__(self, server, sock, address):
+        super(Session, self).__init__(loop=server.loop, parent=server.shell)
+        self.sharecommands(server.shell)
+        self.server = server
+        self.sock = sock
+        self.address = address
+        self.pending = []
+        self.writing = False
+        self.closed = False
+        self.reading = False
+        self.subshell = None    # Future of the subshell running on its own thread
+        self.loopthread = thread.get_ident()
+        self.reader = asyncshell.LineReader(self.loop, sock.fileno())
+        self._outendpoints = {0:self.send}
+        self._inendpoints = {0:self.readline}
+
+    def send(self, data=None):
+        """ Output endpoint: queues a line for the client """
+        self.write(str(data) + "\n")
+        return True
+
+    def readline(self, prompt=None):
+        """
+        Input endpoint: sends the prompt and returns a Future for the next
+        line. Synchronous callers get the line itself: a subshell REPL on
+        its own thread waits for it there, any other caller runs the loop
+        until it arrives.
+        """
+        if thread.get_ident() != self.loopthread:
+            return self.waitline(prompt)
+        if prompt:
+            self.write(prompt)
+        future = self.reader.readline()
+        if self.reading:
+            return future
+        self.loop.run(until=lambda: future.done or self.closed)
+        if not future.done or future.result is None:
+            raise Disconnected()
+        return future.get()
+
+    def waitline(self, prompt):
+        """ Blocking readline() for a subshell running on its own thread """
+        lines = []
+        arrived = threading.Event()
+        def read():
+            if prompt:
+                self.write(prompt)
+            future = self.reader.readline()
+            future.adddonecallback(lambda future: (lines.append(future.result), arrived.set()))
+        self.loop.callthreadsafe(read)
+        # short timeouts notice a session closed before its line arrived
+        while not arrived.wait(0.1):
+            if self.closed:
+                raise Disconnected()
+        if lines[0] is None:
+            raise Disconnected()
+        return lines[0]
+
+    def input(self, data, endpoint=None):
+        if self.subshell is not None:
+            return self.aftersubshell(data, endpoint)
+        self.reading = True # the session's own REPL awaits the Future
+        try:
+            return super(Session, self).input(data, endpoint)
+        finally:
+            self.reading = False
+
+    def aftersubshell(self, data, endpoint):
+        """ Future for the REPL's next line, read once the running subshell has exited """
+        future = asyncshell.Future()
+        def resume(subshell):
+            self.subshell = None
+            if self.closed:
+                future.setresult(None)
+            else:
+                self.input(data, endpoint).adddonecallback(lambda line: future.setresult(line.result))
+        self.subshell.adddonecallback(resume)
+        return future
+
+    def dispatch(self, args, input):
+        command = args and self.getcmd(args[0])
+        # subshells, and manifest stubs that may turn out to be one, get a thread
+        if command and (command.parent or isinstance(command.fn, spys.LazyCommand)):
+            self.subshell = self.loop.runinthread(self.runsubshell, args, input)
+            return None
+        return super(Session, self).dispatch(args, input)
+
+    def runsubshell(self, args, input):
+        # the loop thread does not prompt while the subshell runs, so the
+        # subshell delivers any background job output queued meanwhile
+        deferred = self.outputqueue is not None
+        if deferred:
+            self.deferoutput()
+        try:
+            result = super(Session, self).dispatch(args, input)
+            if spys.isstream(result):
+                self.stream(result)
+            elif result:
+                self.output(result)
+        except Disconnected:
+            self.loop.callthreadsafe(self.close)
+        finally:
+            if deferred:
+                self.releaseoutput()
+
+    def write(self, text):
+        if thread.get_ident() != self.loopthread:
+            self.loop.callthreadsafe(self.write, text)
+            return
+        if self.closed:
+            return
+        self.pending.append(text)
+        if not self.writing:
+            self.writing = True
+            self.loop.addwriter(self.sock.fileno(), self.onwritable)
+
+    def onwritable(self):
+        data = "".join(self.pending)
+        try:
+            sent = self.sock.send(data)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EINTR):
+                return
+            self.pending = []
+            sent = len(data) # client went away, nothing left to deliver
+        self.pending = [data[sent:]] if sent < len(data) else []
+        if not self.pending:
+            self.writing = False
+            self.loop.removewriter(self.sock.fileno())
+            if not self.running:
+                self.close()
+
+    def evaluate(self, input):
+        try:
+            super(Session, self).evaluate(input.rstrip("\r"))
+        except Disconnected:
+            self.close()
+
+    def open(self):
+        self.running = True
+        self.loop.spawn(self.repl())
+
+    def stop(self):
+        super(Session, self).stop()
+        if not self.writing:
+            self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.running = False
+        self.loop.removereader(self.sock.fileno())
+        self.loop.removewriter(self.sock.fileno())
+        self.sock.close()
+        self.server.sessions.discard(self)
+
+
+class SPyServer(object):
+    """
+    Accepts sessions on one or more listening sockets. address is a path
+    for a Unix-domain socket or a (host, port) tuple for TCP.
+    """
+    def __init__(self, shell=None, loop=None):
+        self.shell = shell or spys.SPyShell()
+        self.loop = loop or asyncshell.EventLoop()
+        self.listeners = []
+        self.sessions = set()
+        self.running = False
+        self.shell.setcmd('sessions', self.listsessions, "lists connected sessions")
+
+    def listen(self, address, backlog=128):
+        if isinstance(address, basestring):
+            if os.path.exists(address):
+                os.remove(address) # stale socket from an earlier run
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(address)
+        sock.listen(backlog)
+        sock.setblocking(False)
+        self.loop.addreader(sock.fileno(), lambda: self.accept(sock))
+        self.listeners.append((sock, address))
+        return sock.getsockname()
+
+    def accept(self, listener):
+        while True:
+            try:
+                (sock, address) = listener.accept()
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EINTR, errno.ECONNABORTED):
+                    return
+                raise
+            sock.setblocking(False)
+            session = Session(self, sock, address or "unix#%d" % sock.fileno())
+            self.sessions.add(session)
+            session.open()
+
+    def listsessions(self, *args):
+        '''lists connected sessions'''
+        return "\n".join(str(session.address) for session in self.sessions)
+
+    def serve(self):
+        """ Runs the event loop until stop() or Ctrl-C """
+        self.running = True
+        try:
+            self.loop.run(until=lambda: not self.running)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+
+    def stop(self):
+        self.running = False
+
+    def close(self):
+        for session in list(self.sessions):
+            session.close()
+        for (sock, address) in self.listeners:
+            self.loop.removereader(sock.fileno())
+            sock.close()
+            if isinstance(address, basestring) and os.path.exists(address):
+                os.remove(address)
+        self.listeners = []
+
+
+def connect(address):
+    if isinstance(address, basestring):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    else:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.connect(address)
+    sock.setblocking(False)
+    return sock
+
+def loadtest(address, sessions=100, commands=100, line="print x", prompt="spys> "):
+    """
+    Opens sessions connections at once, then has each run line commands
+    times, waiting for the prompt after every command. Returns
+    (sessions/s, commands/s): how fast all sessions reached their first
+    prompt, and command throughput across all of them.
+    """
+    start = time.time()
+    clients = {}
+    for i in xrange(sessions):
+        sock = connect(address)
+        clients[sock.fileno()] = [sock, "", -1] # socket, unread output, commands sent
+    opened = None
+    connecting = waiting = len(clients)
+    while waiting:
+        readable = select.select(list(clients), [], [])[0]
+        for fd in readable:
+            client = clients[fd]
+            data = client[0].recv(65536)
+            if not data:
+                raise IOError("server closed session %d" % fd)
+            client[1] += data
+            if not client[1].endswith(prompt):
+                continue
+            client[1] = ""
+            client[2] += 1
+            if client[2] == 0:
+                connecting -= 1
+                if not connecting:
+                    opened = time.time()
+            if client[2] < commands:
+                client[0].sendall(line + "\n")
+            else:
+                waiting -= 1
+    finished = time.time()
+    for client in clients.values():
+        client[0].close()
+    opened = opened or finished
+    return (sessions / max(opened - start, 1e-9), sessions * commands / max(finished - start, 1e-9))
+
+
+if __name__ == "__main__":
+    import optparse
+    parser = optparse.OptionParser(usage="%prog [--unix PATH | --host HOST --port N] [-l module] [--loadtest]")
+    parser.add_option("--unix", help="listen on a Unix-domain socket at PATH")
+    parser.add_option("--host", default="127.0.0.1", help="TCP address to listen on (default: %default)")
+    parser.add_option("--port", type="int", default=7755, help="TCP port (default: %default)")
+    parser.add_option("-l", "--load", action="append", default=[], help="plugin to load before serving")
+    parser.add_option("--loadtest", action="store_true", help="run the load-test client against a server")
+    parser.add_option("--sessions", type="int", default=100, help="load-test sessions (default: %default)")
+    parser.add_option("--commands", type="int", default=100, help="commands per session (default: %default)")
+    (options, args) = parser.parse_args()
+    address = options.unix or (options.host, options.port)
+    if options.loadtest:
+        (sessionrate, commandrate) = loadtest(address, options.sessions, options.commands)
+        print "%d sessions x %d commands: %.0f sessions/s, %.0f commands/s" % (
+            options.sessions, options.commands, sessionrate, commandrate)
+    else:
+        server = SPyServer()
+        for module in options.load:
+            server.shell.loadmodule(module, lazy=False)
+        print "listening on %s" % (server.listen(address),)
+        server.serve()
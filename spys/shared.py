@@ -0,0 +1,539 @@
+"""
+Shared-state containers for the SPyIO.shared property.
+"""
+import array, contextlib, cPickle, errno, fcntl, mmap, os, struct, tempfile, threading, time
+
+class SharedState(object):
+    """
+    Dict-like container that is safe to update from many threads at once.
+
+    Keys are spread over a number of stripes by hash, each a dict with its
+    own lock, so threads working on different keys rarely wait on each
+    other. Reads of a single key take no lock; writes, the atomic
+    modify() and compareandset(), and other read-modify-write operations
+    lock only the key's stripe. snapshot() holds every stripe lock at
+    once and returns a consistent plain dict copy.
+    """
+    def __init__(self, data=None, stripes=16):
+        self.stripes = [({}, threading.Lock()) for x in range(stripes)]
+        self.count = stripes
+        if data:
+            self.update(data)
+
+    def __getitem__(self, key):
+        return self.stripes[hash(key) % self.count][0][key]
+
+    def get(self, key, default=None):
+        return self.stripes[hash(key) % self.count][0].get(key, default)
+
+    def __contains__(self, key):
+        return key in self.stripes[hash(key) % self.count][0]
+
+    def __setitem__(self, key, value):
+        (data, lock) = self.stripes[hash(key) % self.count]
+        with lock:
+            data[key] = value
+
+    def __delitem__(self, key):
+        (data, lock) = self.stripes[hash(key) % self.count]
+        with lock:
+            del(data[key])
+
+    def setdefault(self, key, default=None):
+        (data, lock) = self.stripes[hash(key) % self.count]
+        with lock:
+            return data.setdefault(key, default)
+
+    def pop(self, key, *default):
+        (data, lock) = self.stripes[hash(key) % self.count]
+        with lock:
+            return data.pop(key, *default)
+
+    def modify(self, key, fn, default=None):
+        """
+        Atomically replaces the value of key (default if unset) with
+        fn(value) and returns the new value. fn runs with the key's stripe
+        locked, so it must not touch the container itself.
+        """
+        (data, lock) = self.stripes[hash(key) % self.count]
+        with lock:
+            value = data[key] = fn(data.get(key, default))
+            return value
+
+    def compareandset(self, key, expected, value):
+        """
+        Sets key to value only if it currently holds expected (missing keys
+        compare equal to None). Returns True if the value was set.
+        """
+        (data, lock) = self.stripes[hash(key) % self.count]
+        with lock:
+            if data.get(key) != expected:
+                return False
+            data[key] = value
+            return True
+
+    def update(self, *args, **kwargs):
+        for (key, value) in dict(*args, **kwargs).iteritems():
+            self[key] = value
+
+    def clear(self):
+        for (data, lock) in self.stripes:
+            with lock:
+                data.clear()
+
+    def snapshot(self):
+        """ Consistent copy of the whole container as a plain dict """
+        for (data, lock) in self.stripes:
+            lock.acquire()
+        try:
+            copy = {}
+            for (data, lock) in self.stripes:
+                copy.update(data)
+            return copy
+        finally:
+            for (data, lock) in self.stripes:
+                lock.release()
+
+    copy = snapshot
+
+    def __len__(self):
+        return sum(len(data) for (data, lock) in self.stripes)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        return self.snapshot().keys()
+
+    def values(self):
+        return self.snapshot().values()
+
+    def items(self):
+        return self.snapshot().items()
+
+    # the Python 2 dict API plugins written against a plain shared dict use
+    def has_key(self, key):
+        return key in self
+
+    def iterkeys(self):
+        return iter(self.keys())
+
+    def itervalues(self):
+        return iter(self.values())
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def __eq__(self, other):
+        if isinstance(other, SharedState):
+            other = other.snapshot()
+        return self.snapshot() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "SharedState(%r)" % self.snapshot()
+
+    def __getstate__(self):
+        return (self.snapshot(), self.count)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+
+
+# Compact, type-tagged encoding used by SharedMemoryState. Anything not
+# listed falls back to pickle.
+_HEADER = struct.Struct("<4sQQQ")    # magic, version, body length, capacity
+_MAGIC = "SPYS"
+_SIZE = struct.Struct("<I")
+_INT = struct.Struct("<q")
+_FLOAT = struct.Struct("<d")
+SHMDIR = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+
+# segment path => the lock writers in this process take before the file lock,
+# shared by every handle on the segment
+_pathlocks = {}
+_pathlockslock = threading.Lock()
+
+def pathlock(path):
+    with _pathlockslock:
+        return _pathlocks.setdefault(path, threading.Lock())
+
+def encode(value, out):
+    """ Appends the encoding of value to out, a list of strings """
+    kind = type(value)
+    if value is None:
+        out.append("N")
+    elif kind is bool:
+        out.append("T" if value else "F")
+    elif kind is int or (kind is long and -2**63 <= value < 2**63):
+        out.append("i" + _INT.pack(value))
+    elif kind is float:
+        out.append("d" + _FLOAT.pack(value))
+    elif kind is str:
+        out.append("s" + _SIZE.pack(len(value)))
+        out.append(value)
+    elif kind is unicode:
+        value = value.encode("utf-8")
+        out.append("u" + _SIZE.pack(len(value)))
+        out.append(value)
+    elif kind is array.array:
+        data = value.tostring()
+        out.append("a" + value.typecode + _SIZE.pack(len(data)))
+        out.append(data)
+    elif kind is tuple or kind is list:
+        out.append(("t" if kind is tuple else "l") + _SIZE.pack(len(value)))
+        for item in value:
+            encode(item, out)
+    elif kind is dict:
+        out.append("m" + _SIZE.pack(len(value)))
+        for (key, item) in value.iteritems():
+            encode(key, out)
+            encode(item, out)
+    else:
+        data = cPickle.dumps(value, 2)
+        out.append("p" + _SIZE.pack(len(data)))
+        out.append(data)
+
+def decode(buf, pos, spans=None):
+    """
+    Decodes the value encoded at buf[pos:], returning (value, end). If
+    spans is a list, the (offset, length) of the raw data of a str or
+    array value is appended to it.
+    """
+    tag = buf[pos]
+    pos += 1
+    if tag == "N":
+        return (None, pos)
+    elif tag == "T" or tag == "F":
+        return (tag == "T", pos)
+    elif tag == "i":
+        return (_INT.unpack_from(buf, pos)[0], pos + _INT.size)
+    elif tag == "d":
+        return (_FLOAT.unpack_from(buf, pos)[0], pos + _FLOAT.size)
+    elif tag == "a":
+        typecode = buf[pos]
+        pos += 1
+    elif tag in "tlm":
+        count = _SIZE.unpack_from(buf, pos)[0]
+        pos += _SIZE.size
+        items = []
+        for x in xrange(count * 2 if tag == "m" else count):
+            (item, pos) = decode(buf, pos)
+            items.append(item)
+        if tag == "m":
+            return (dict(zip(items[::2], items[1::2])), pos)
+        return (tuple(items) if tag == "t" else items, pos)
+    elif tag not in "sup":
+        raise ValueError("bad tag %r at offset %d" % (tag, pos - 1))
+    size = _SIZE.unpack_from(buf, pos)[0]
+    pos += _SIZE.size
+    data = buf[pos:pos + size]
+    if spans is not None:
+        spans.append((pos, size))
+    if tag == "s":
+        value = data
+    elif tag == "u":
+        value = data.decode("utf-8")
+    elif tag == "a":
+        value = array.array(typecode)
+        value.fromstring(data)
+    else:
+        value = cPickle.loads(data)
+    return (value, pos + size)
+
+
+class SharedMemoryState(object):
+    """
+    Dict-like shared state that other processes can attach to by name.
+
+    The contents live in one memory-mapped segment under SHMDIR (/dev/shm
+    where available), encoded compactly by encode(). Readers take no lock:
+    the decoded dict is cached and only decoded again when the segment's
+    version counter has moved, and a reader that catches a write in
+    progress retries (a seqlock). Writers serialize on a lock per segment
+    within a process and a file lock between processes, so updates from
+    any process, thread or handle are atomic, but each one rewrites the
+    whole segment; keep it to state that changes less often than it is
+    read. A write left unfinished by a writer that was killed is read as
+    it was left, if it decodes, and is repaired by the next write.
+
+    view(key) returns str and array values as read-only buffers straight
+    into the segment, without copying them.
+
+    Pickling a SharedMemoryState pickles only its name, so passing one to
+    a multiprocessing worker attaches the worker to the same segment. The
+    creating process should unlink() the segment when it is done.
+    """
+    def __init__(self, name=None, create=None, size=1 << 16):
+        if name is None:
+            name = "spys-%d-%s" % (os.getpid(), os.urandom(4).encode("hex"))
+            create = True
+        self.name = name
+        self.path = os.path.join(SHMDIR, name)
+        self.lock = pathlock(self.path)
+        self.pid = os.getpid()
+        self.version = None
+        self.data = {}
+        self.spans = {}
+        if create:
+            self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0600)
+            os.ftruncate(self.fd, max(size, _HEADER.size + 16))
+            self.map = mmap.mmap(self.fd, max(size, _HEADER.size + 16))
+            body = "m" + _SIZE.pack(0)
+            self.map[_HEADER.size:_HEADER.size + len(body)] = body
+            _HEADER.pack_into(self.map, 0, _MAGIC, 0, len(body), len(self.map))
+        else:
+            self.fd = os.open(self.path, os.O_RDWR)
+            self.map = mmap.mmap(self.fd, os.fstat(self.fd).st_size)
+            if self.map[:4] != _MAGIC:
+                self.close()
+                raise ValueError("%s is not a SPyS shared state segment" % self.path)
+
+    @classmethod
+    def attach(cls, name):
+        return cls(name, create=False)
+
+    def load(self, held=False):
+        """
+        Current contents, decoded again only if another writer got in.
+        held is set by locked(), whose caller is the only possible writer.
+        """
+        spins = 0
+        while True:
+            (magic, version, length, capacity) = _HEADER.unpack_from(self.map, 0)
+            if version == self.version:
+                return self.data
+            if version & 1 and not held:
+                # a write is in progress: spin briefly, then back off while
+                # a writer holds the lock; if none does, its writer died
+                spins += 1
+                if spins < 1000:
+                    continue
+                if self.writing():
+                    time.sleep(0.001)
+                    continue
+            stale = version & 1
+            if capacity > len(self.map):
+                # grown by another process; views into the old map keep it alive
+                self.map = mmap.mmap(self.fd, capacity)
+            try:
+                (data, spans) = self.read()
+            except Exception:
+                if stale and held:
+                    return self.data # the last contents seen, which the caller's write restores
+                if stale:
+                    raise ValueError("%s was left half written by a writer that died" % self.path)
+                data = None # torn read, the version check below retries
+            if _HEADER.unpack_from(self.map, 0)[1] == version and data is not None:
+                (self.data, self.spans, self.version) = (data, spans, version)
+                return data
+
+    def read(self):
+        """
+        Decodes the segment into a dict, along with the offsets of the raw
+        data of its str and array values
+        """
+        pos = _HEADER.size + 1 + _SIZE.size
+        data = {}
+        spans = {}
+        for x in xrange(_SIZE.unpack_from(self.map, _HEADER.size + 1)[0]):
+            (key, pos) = decode(self.map, pos)
+            found = []
+            (value, pos) = decode(self.map, pos, found)
+            data[key] = value
+            if type(value) in (str, array.array):
+                spans[key] = found[0]
+        return (data, spans)
+
+    def lockfd(self):
+        """
+        Descriptor for the file lock. flock() locks belong to the open
+        file, which a forked child shares with its parent, so a child
+        opens the segment again.
+        """
+        if self.pid != os.getpid():
+            os.close(self.fd) # the child's copy; the parent's stays open
+            self.fd = os.open(self.path, os.O_RDWR)
+            self.pid = os.getpid()
+        return self.fd
+
+    def writing(self):
+        """ True while a writer in any process holds the write lock """
+        if self.lock.locked():
+            return True
+        try:
+            fcntl.flock(self.lockfd(), fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except IOError, e:
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                return True
+            raise
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        return False
+
+    @contextlib.contextmanager
+    def locked(self):
+        """ Holds the write lock; yields a copy of the contents to change and store() """
+        with self.lock:
+            fd = self.lockfd()
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                yield dict(self.load(True))
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+
+    def store(self, data):
+        """
+        Writes data as the new contents; only call with locked() held. An
+        odd version, left by a writer that died mid-write, is kept for
+        this write, so the version is even again once it is done.
+        """
+        out = []
+        encode(data, out)
+        body = "".join(out)
+        capacity = len(self.map)
+        if _HEADER.size + len(body) > capacity:
+            capacity = max(capacity * 2, _HEADER.size + len(body))
+            os.ftruncate(self.fd, capacity)
+            self.map = mmap.mmap(self.fd, capacity)
+        version = _HEADER.unpack_from(self.map, 0)[1] | 1
+        _HEADER.pack_into(self.map, 0, _MAGIC, version, len(body), capacity)
+        self.map[_HEADER.size:_HEADER.size + len(body)] = body
+        _HEADER.pack_into(self.map, 0, _MAGIC, version + 1, len(body), capacity)
+
+    def __getitem__(self, key):
+        return self.load()[key]
+
+    def get(self, key, default=None):
+        return self.load().get(key, default)
+
+    def __contains__(self, key):
+        return key in self.load()
+
+    def view(self, key):
+        """ Read-only buffer over a str or array value, valid until the next write """
+        self.load()
+        if key not in self.spans:
+            raise KeyError(key)
+        (offset, length) = self.spans[key]
+        return buffer(self.map, offset, length)
+
+    def __setitem__(self, key, value):
+        with self.locked() as data:
+            data[key] = value
+            self.store(data)
+
+    def __delitem__(self, key):
+        with self.locked() as data:
+            del(data[key])
+            self.store(data)
+
+    def setdefault(self, key, default=None):
+        with self.locked() as data:
+            if key not in data:
+                data[key] = default
+                self.store(data)
+            return data[key]
+
+    def pop(self, key, *default):
+        with self.locked() as data:
+            if key not in data:
+                return data.pop(key, *default)
+            value = data.pop(key)
+            self.store(data)
+            return value
+
+    def modify(self, key, fn, default=None):
+        """ Atomically replaces the value of key with fn(value), across processes """
+        with self.locked() as data:
+            value = data[key] = fn(data.get(key, default))
+            self.store(data)
+            return value
+
+    def compareandset(self, key, expected, value):
+        """ Sets key to value only if it currently holds expected """
+        with self.locked() as data:
+            if data.get(key) != expected:
+                return False
+            data[key] = value
+            self.store(data)
+            return True
+
+    def update(self, *args, **kwargs):
+        with self.locked() as data:
+            data.update(*args, **kwargs)
+            self.store(data)
+
+    def clear(self):
+        with self.locked() as data:
+            self.store({})
+
+    def snapshot(self):
+        return dict(self.load())
+
+    copy = snapshot
+
+    def __len__(self):
+        return len(self.load())
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        return self.load().keys()
+
+    def values(self):
+        return self.load().values()
+
+    def items(self):
+        return self.load().items()
+
+    def has_key(self, key):
+        return key in self.load()
+
+    def iterkeys(self):
+        return iter(self.keys())
+
+    def itervalues(self):
+        return iter(self.values())
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def __eq__(self, other):
+        if isinstance(other, (SharedState, SharedMemoryState)):
+            other = other.snapshot()
+        return self.load() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "SharedMemoryState(%r, %r)" % (self.name, self.load())
+
+    def __getstate__(self):
+        return self.name
+
+    def __setstate__(self, name):
+        self.__init__(name, create=False)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        self.map = None # buffers from view() may still hold the mapping
+
+    def __del__(self):
+        # handles attached by unpickling are usually just dropped
+        if getattr(self, 'fd', None) is not None:
+            self.close()
+
+    def unlink(self):
+        """ Removes the segment; processes still attached keep their mapping """
+        try:
+            os.remove(self.path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
@@ -1,30 +1,755 @@
-import inspect, shlex, traceback, types
+import collections, cProfile, errno, hashlib, imp, inspect, marshal, multiprocessing, os, pipes, pstats, re, stat, StringIO, sys, tempfile, thread, threading, time, traceback, types
+from multiprocessing.pool import ThreadPool
+from history import HistoryStore
+from metrics import Metrics
+from profiler import Sampler
+from shared import SharedMemoryState, SharedState
 
-class FixedStack(object):
+# characters that force a line off the str.split() fast path in split()
+_SPECIAL = re.compile(r'[\'"\\\x0b\x0c]')
+_TOKEN = re.compile(r'''
+      (?P<space>[ \t\r\n]+)
+    | (?P<word>[^ \t\r\n'"\\]+)
+    | '(?P<single>[^']*)'
+    | "(?P<double>(?:[^"\\]|\\.)*)"
+    | \\(?P<escape>.)
+    ''', re.S | re.X)
+_DQESCAPE = re.compile(r'\\(["\\])')
+
+def splitpipeline(line):
+    """
+    Splits a command line on unquoted, whitespace separated '|' tokens.
+    Lines that are not pipelines come back as a single segment.
+    """
+    segments = []
+    start = pos = 0
+    previous = 'space'
+    end = len(line)
+    while pos < end:
+        match = _TOKEN.match(line, pos)
+        if match is None:
+            break # quoting errors are left for split() to report
+        kind = match.lastgroup
+        if kind == 'word' and previous == 'space' and match.group(kind) == '|' and \
+           (match.end() == end or line[match.end()] in ' \t\r\n'):
+            segments.append(line[start:match.start()])
+            start = match.end()
+        previous = kind
+        pos = match.end()
+    segments.append(line[start:])
+    return segments
+
+def splitbackground(line):
+    """
+    Returns the command line in front of a trailing, unquoted '&', or
+    None if the line does not end with one.
+    """
+    line = line.rstrip()
+    last = None
+    pos = 0
+    end = len(line)
+    while pos < end:
+        last = _TOKEN.match(line, pos)
+        if last is None:
+            return None # quoting errors are left for split() to report
+        pos = last.end()
+    if last is not None and last.lastgroup == 'word' and last.group('word').endswith('&'):
+        return line[:-1].rstrip()
+    return None
+
+def isstream(value):
+    """ True for iterators (generators, files...), which commands return to stream output """
+    return hasattr(value, 'next') and iter(value) is value
+
+def records(value):
+    """ Iterator over the records of a command result """
+    if value is None:
+        return iter(())
+    if isstream(value):
+        return value
+    return iter((value,))
+
+def drain(value):
+    """ Runs a streamed result to the end, for callers with no use for its records """
+    if isstream(value):
+        for record in value:
+            pass
+
+def split(line):
+    """
+    Splits a command line into arguments with the same results as
+    shlex.split(line) (POSIX quoting, no comments), but several times faster.
+    Lines without quotes or escapes are split with str.split().
+    """
+    if type(line) is str and not _SPECIAL.search(line):
+        return line.split()
+    tokens = []
+    parts = None
+    pos = 0
+    end = len(line)
+    while pos < end:
+        match = _TOKEN.match(line, pos)
+        if match is None:
+            rest = line[pos + 1:]
+            if line[pos] == '"' and (len(rest) - len(rest.rstrip('\\'))) % 2:
+                raise ValueError("No escaped character")
+            elif line[pos] == '\\':
+                raise ValueError("No escaped character")
+            raise ValueError("No closing quotation")
+        kind = match.lastgroup
+        if kind == 'space':
+            if parts is not None:
+                tokens.append(''.join(parts))
+                parts = None
+        else:
+            if parts is None:
+                parts = []
+            if kind == 'double':
+                parts.append(_DQESCAPE.sub(r'\1', match.group(kind)))
+            else:
+                parts.append(match.group(kind))
+        pos = match.end()
+    if parts is not None:
+        tokens.append(''.join(parts))
+    return tokens
+
+def readmanifest(name):
+    """
+    Returns the (command, help) pairs listed in a plugin's manifest, the
+    <module>.manifest file next to it, without importing the plugin. Each
+    manifest line holds a command name, optionally followed by its help
+    text; blank lines and lines starting with # are skipped. Returns None
+    when the plugin has no manifest.
+    """
+    try:
+        (file, path, description) = imp.find_module(name)
+    except ImportError:
+        return None
+    if file:
+        file.close()
+    if description[2] == imp.PKG_DIRECTORY:
+        path = os.path.join(path, "__init__")
+    try:
+        manifest = open(os.path.splitext(path)[0] + ".manifest")
+    except IOError:
+        return None
+    commands = []
+    for line in manifest:
+        line = line.strip()
+        if line and not line.startswith("#"):
+            fields = line.split(None, 1)
+            commands.append((fields[0], fields[1] if len(fields) > 1 else None))
+    manifest.close()
+    return commands
+
+class Plugin(object):
+    """
+    Change tracking for a loaded plugin module. Modules are process-wide,
+    so one Plugin per module is shared by every shell that loads it.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.path = None
+        self.stamp = None       # (mtime, size) of the source when last checked
+        self.digest = None      # sha1 of the source when last loaded
+        self.version = 0        # bumped on every import or reload
+        self.exports = None     # spys_exports() of the current version
+        self.reloads = 0
+        self.skipped = 0
+        self.lasttime = 0.0
+        self.totaltime = 0.0
+
+    def source(self, module):
+        path = getattr(module, '__file__', None)
+        if path and path[-4:] in ('.pyc', '.pyo') and os.path.exists(path[:-1]):
+            path = path[:-1]
+        return path
+
+    def fingerprint(self):
+        stat = os.stat(self.path)
+        return ((stat.st_mtime, stat.st_size), hashlib.sha1(open(self.path, 'rb').read()).hexdigest())
+
+    def changed(self):
+        """
+        True if the source differs from the loaded version. Files are only
+        hashed when their mtime or size moved, so unchanged plugins cost one
+        stat() per check.
+        """
+        if not self.version or not self.path:
+            return not self.version
+        try:
+            stat = os.stat(self.path)
+            if (stat.st_mtime, stat.st_size) == self.stamp:
+                return False
+            (stamp, digest) = self.fingerprint()
+        except (IOError, OSError):
+            return False
+        if digest == self.digest:
+            self.stamp = stamp # touched but not modified
+            return False
+        return True
+
+    def purgecompiled(self):
+        """
+        Removes bytecode for the source before a reload: .pyc files only
+        record the source mtime to the second, so an edit made within the
+        same second would otherwise be ignored.
+        """
+        for suffix in ('c', 'o'):
+            if self.path:
+                try:
+                    os.remove(self.path + suffix)
+                except OSError:
+                    pass
+
+    def loaded(self, module, exports, elapsed):
+        if self.version:
+            self.reloads += 1
+        self.version += 1
+        self.exports = exports
+        self.lasttime = elapsed
+        self.totaltime += elapsed
+        self.path = self.source(module)
+        try:
+            (self.stamp, self.digest) = self.fingerprint()
+        except (IOError, OSError, TypeError):
+            (self.stamp, self.digest) = (None, None)
+
+# plugin module name => Plugin
+_plugins = {}
+
+# bump when the on-disk script plan format changes
+PLAN_VERSION = 3
+
+class RingBuffer(object):
+    """
+    Fixed-capacity history stack. append() pushes a value, discarding the
+    oldest one when full, and pop() removes the newest one; both are O(1).
+    Indexing and items() see the buffer oldest first, padded at the front
+    with None, so [-1] is always the most recent value.
+    """
     def __init__(self, size):
         self.size = size
-        self.buffer = [None for x in range(0, size)]
+        self.buffer = [None] * size
+        self.head = 0   # slot the next append() writes to
+        self.count = 0
 
     def __getitem__(self, key):
-        return self.buffer[key]
+        if isinstance(key, slice):
+            return self.items()[key]
+        if key < 0:
+            key += self.size
+        if not 0 <= key < self.size:
+            raise IndexError("RingBuffer index out of range")
+        return self.buffer[(self.head + key) % self.size]
 
     def __len__(self):
-        return len(self.buffer)
+        return self.size
 
     def items(self):
-        return self.buffer
-    
+        return self.buffer[self.head:] + self.buffer[:self.head]
+
     def append(self, value):
-        del(self.buffer[0])
-        self.buffer.append(value)
+        self.buffer[self.head] = value
+        self.head = (self.head + 1) % self.size
+        if self.count < self.size:
+            self.count += 1
 
     def pop(self):
-        self.buffer.insert(0, None)
-        return self.buffer.pop()
+        if not self.count:
+            return None
+        self.head = (self.head - 1) % self.size
+        value = self.buffer[self.head]
+        self.buffer[self.head] = None
+        self.count -= 1
+        return value
 
     def top(self):
-        return self.buffer[-1]
+        return self.buffer[(self.head - 1) % self.size]
+
+# older name, kept for plugins importing it
+FixedStack = RingBuffer
+
+
+class LRUCache(object):
+    """
+    Bounded mapping that evicts an entry not used recently when full,
+    keeping hit and miss counts for get(). Eviction is the second-chance
+    (CLOCK) approximation of least recently used: a hit only flags its
+    entry, so lookups take no lock, while inserts lock. That makes it
+    safe to share between threads, such as background jobs.
+    """
+    def __init__(self, size=256):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.__lock = threading.Lock()
+        self.__map = {}
+        self.__root = []  # circular doubly linked list of [prev, next, key, value, used]
+        self.__root[:] = [self.__root, self.__root, None, None, False]
+
+    def __len__(self):
+        return len(self.__map)
+
+    def __contains__(self, key):
+        return key in self.__map
+
+    def __unlink(self, link):
+        link[0][1] = link[1]
+        link[1][0] = link[0]
+
+    def __append(self, link):
+        root = self.__root
+        last = root[0]
+        last[1] = root[0] = link
+        link[0] = last
+        link[1] = root
+
+    def __evict(self):
+        root = self.__root
+        while True:
+            oldest = root[1]
+            self.__unlink(oldest)
+            if not oldest[4]:
+                del(self.__map[oldest[2]])
+                return
+            oldest[4] = False # used since it was last passed over, give it another round
+            self.__append(oldest)
 
+    def get(self, key, default=None):
+        link = self.__map.get(key)
+        if link is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        link[4] = True
+        return link[3]
+
+    def __setitem__(self, key, value):
+        if self.size <= 0:
+            return
+        with self.__lock:
+            link = self.__map.get(key)
+            if link is not None:
+                link[3] = value
+                link[4] = True
+                return
+            if len(self.__map) >= self.size:
+                self.__evict()
+            link = [None, None, key, value, False]
+            self.__map[key] = link
+            self.__append(link)
+
+    def __delitem__(self, key):
+        with self.__lock:
+            self.__unlink(self.__map.pop(key))
+
+    def clear(self):
+        with self.__lock:
+            self.__map.clear()
+            self.__root[:] = [self.__root, self.__root, None, None, False]
+
+    def ratio(self):
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0.0
+
+
+class LazyCommand(object):
+    """
+    Stub bound by loadmodule() for a command listed in a plugin manifest.
+    The first call imports the plugin, which replaces the stubs with the
+    real exports, and then forwards the call. Calls run in the shell that
+    made them, which in a shared command table need not be the one that
+    bound the stub.
+    """
+    def __init__(self, shell, module, name, help=None):
+        self.shell = shell
+        self.module = module
+        self.name = name
+        self.__doc__ = help
+
+    def __call__(self, *args, **kwargs):
+        shell = kwargs.get('instance', self.shell)
+        shell.loadmodule(self.module, lazy=False)
+        command = shell.getcmd(self.name)
+        if command is None or command.fn is self:
+            raise NameError("%s does not export %s" % (self.module, self.name))
+        return command(shell, args)
+
+
+class CommandTable(dict):
+    """
+    Command table layered over a shared one. Commands bound in this table
+    itself (the built-ins) take precedence and are rebound and unbound
+    here; lookups of anything else fall through to the shared table and
+    new bindings are made there, so every shell layered over the same
+    table sees them. An unbound built-in stays masked as None, so it does
+    not fall through to the shared table's command of the same name.
+    """
+    def __init__(self, local, shared):
+        dict.__init__(self, local)
+        self.shared = shared
+
+    def get(self, key, default=None):
+        if dict.__contains__(self, key):
+            value = dict.__getitem__(self, key)
+            return default if value is None else value
+        return self.shared.get(key, default)
+
+    def __getitem__(self, key):
+        if dict.__contains__(self, key):
+            value = dict.__getitem__(self, key)
+            if value is None:
+                raise KeyError(key)
+            return value
+        return self.shared[key]
+
+    def __contains__(self, key):
+        if dict.__contains__(self, key):
+            return dict.__getitem__(self, key) is not None
+        return key in self.shared
+
+    def __setitem__(self, key, value):
+        if dict.__contains__(self, key):
+            dict.__setitem__(self, key, value)
+        else:
+            self.shared[key] = value
+
+    def __delitem__(self, key):
+        if dict.__contains__(self, key):
+            if dict.__getitem__(self, key) is None:
+                raise KeyError(key)
+            dict.__setitem__(self, key, None)
+        else:
+            del(self.shared[key])
+
+    def __iter__(self):
+        return iter(set(key for (key, value) in dict.items(self) if value is not None) |
+                    set(key for key in self.shared if not dict.__contains__(self, key)))
+
+    def keys(self):
+        return list(self)
+
+
+class Command(object):
+    """
+    Dispatch table entry. The calling convention of a bound callable is
+    resolved once, when it is registered, so that handle() only has to do a
+    single dict lookup per line.
+    """
+    __slots__ = ('name', 'fn', 'instance', 'parent', 'stream', 'plain')
+
+    def __init__(self, name, fn):
+        self.name = name
+        self.fn = fn
+        # functions may ask for the calling shell via the magic 'instance' argument,
+        # decorators are seen through via __wrapped__
+        wrapped = getattr(fn, '__wrapped__', fn)
+        self.instance = isinstance(fn, LazyCommand) or \
+                        type(wrapped) == types.FunctionType and \
+                        "instance" in inspect.getargspec(wrapped)[0]
+        # shell classes bound as commands are handed the calling shell as 'parent'
+        self.parent = isinstance(fn, type) and issubclass(fn, SPyIO) and \
+                      inspect.ismethod(fn.__init__) and \
+                      "parent" in inspect.getargspec(fn.__init__)[0]
+        # pipeline stages that take a 'stream' argument consume the upstream iterator
+        self.stream = type(wrapped) in (types.FunctionType, types.MethodType) and \
+                      "stream" in inspect.getargspec(wrapped)[0]
+        self.plain = not (self.instance or self.parent or self.stream)
+
+    def __call__(self, shell, args, stream=None):
+        if self.plain:
+            return self.fn(*args)
+        kwargs = {}
+        if self.instance:
+            kwargs['instance'] = shell
+        if self.parent:
+            kwargs['parent'] = shell
+        if self.stream:
+            kwargs['stream'] = stream
+        return self.fn(*args, **kwargs)
+
+
+class Job(object):
+    """ A command line running in the background, see SPyShell.background() """
+    def __init__(self, id, line):
+        self.id = id
+        self.line = line
+        self.queued = time.time()
+        self.start = None
+        self.end = None
+        self.result = None
+        self.failed = False
+        self.done = threading.Event()
+        self.cancelled = threading.Event()
+
+    def wait(self):
+        # short timeouts keep Ctrl-C working while waiting
+        while not self.done.wait(0.1):
+            pass
+
+    def output(self):
+        if isinstance(self.result, list):
+            return "\n".join(str(item) for item in self.result)
+        return self.result
+
+    def __str__(self):
+        if self.end is not None:
+            state = "failed" if self.failed else "done"
+            elapsed = self.end - self.start
+        elif self.start is not None:
+            (state, elapsed) = ("running", time.time() - self.start)
+        else:
+            (state, elapsed) = ("queued", time.time() - self.queued)
+        return "%-8s %8.3fs  %s" % (state, elapsed, self.line)
+
+
+# output levels, for filtering what fan-out endpoint sinks receive
+DEBUG, INFO, WARNING, ERROR = 10, 20, 30, 40
+
+class Message(object):
+    """
+    Output message formatted on first use: str(Message(fmt, *args)) is
+    fmt % args, computed once. Endpoints that filter a message out never
+    pay for formatting it.
+    """
+    __slots__ = ('fmt', 'args', 'text')
+
+    def __init__(self, fmt, *args):
+        self.fmt = fmt
+        self.args = args
+        self.text = None
+
+    def __str__(self):
+        if self.text is None:
+            self.text = self.fmt % self.args
+        return self.text
+
+
+class TeeEndpoint(object):
+    """
+    Fan-out output endpoint delivering each message to several sinks.
+    Each sink may have a minimum level and a predicate(data, level); a
+    message is formatted once, only if some sink accepts it, and the same
+    string is passed to every accepting sink.
+    """
+    def __init__(self):
+        self.sinks = []
+
+    def add(self, function, level=None, predicate=None):
+        self.sinks.append((function, level, predicate))
+
+    def remove(self, function):
+        self.sinks = [sink for sink in self.sinks if sink[0] is not function]
+
+    def __call__(self, data=None, level=None):
+        if level is None:
+            level = INFO
+        wanted = [function for (function, minimum, predicate) in self.sinks
+                  if (minimum is None or level >= minimum) and
+                     (predicate is None or predicate(data, level))]
+        if not wanted:
+            return False
+        if not isinstance(data, basestring):
+            data = str(data)
+        for function in wanted:
+            function(data)
+        return True
+
+    def flush(self):
+        for (function, minimum, predicate) in self.sinks:
+            if hasattr(function, 'flush'):
+                function.flush()
+
+    def stop(self):
+        for (function, minimum, predicate) in self.sinks:
+            if hasattr(function, 'stop'):
+                function.stop()
+
+
+class BufferedEndpoint(object):
+    """
+    Output endpoint wrapper that collects messages and hands them to the
+    wrapped endpoint in batches: once size messages are waiting, once the
+    oldest has waited interval seconds, or on flush(). The interval is a
+    deadline: a flusher thread delivers a batch whose time is up even if
+    no further message arrives, so a command that outputs once and then
+    works for minutes does not hold its message back. Batches are
+    delivered one at a time and in order, whichever thread delivers
+    them. Batches are joined with newlines into a single call, or with
+    latest set only the newest message of the batch is delivered, which
+    suits status-line style endpoints that overwrite themselves.
+    """
+    def __init__(self, function, size=64, interval=0.05, latest=False):
+        self.function = function
+        self.size = size
+        self.interval = interval
+        self.latest = latest
+        self.pending = []
+        self.since = None
+        self.lock = threading.Condition(threading.Lock())
+        self.delivering = threading.Lock() # taken before lock, keeps batches in order
+        self.flusher = None
+        self.stopping = False
+
+    def __call__(self, data=None):
+        now = time.time()
+        with self.lock:
+            if not self.pending:
+                self.since = now
+                if self.flusher is None:
+                    self.flusher = threading.Thread(target=self.expire, name="spys-output-flusher")
+                    self.flusher.daemon = True
+                    self.flusher.start()
+                else:
+                    self.lock.notify()
+            self.pending.append(data)
+            if len(self.pending) < self.size and now - self.since < self.interval:
+                return True
+        self.send()
+        return True
+
+    def expire(self):
+        """ Flusher thread: delivers batches whose interval is up """
+        while True:
+            with self.lock:
+                while not self.stopping:
+                    if not self.pending:
+                        self.lock.wait()
+                        continue
+                    remaining = self.since + self.interval - time.time()
+                    if remaining <= 0:
+                        break
+                    self.lock.wait(remaining)
+                if self.stopping:
+                    self.flusher = None
+                    return
+            self.send()
+
+    def take(self):
+        batch, self.pending = self.pending, []
+        return batch
+
+    def deliver(self, batch):
+        if not batch:
+            return
+        if self.latest:
+            self.function(batch[-1])
+        elif len(batch) == 1:
+            self.function(batch[0])
+        else:
+            self.function("\n".join(str(data) for data in batch))
+
+    def send(self):
+        with self.delivering:
+            with self.lock:
+                batch = self.take()
+            self.deliver(batch)
+
+    def flush(self):
+        """ Delivers the pending batch and flushes the wrapped endpoint """
+        self.send()
+        if hasattr(self.function, 'flush'):
+            self.function.flush()
+
+    def stop(self):
+        self.flush()
+        with self.lock:
+            flusher = self.flusher
+            self.stopping = True
+            self.lock.notify()
+        if flusher is not None:
+            flusher.join()
+        with self.lock:
+            self.stopping = False
+        if hasattr(self.function, 'stop'):
+            self.function.stop()
+
+
+class ThreadedEndpoint(object):
+    """
+    Output endpoint wrapper that hands messages to a dedicated writer
+    thread through a bounded queue, so a slow endpoint never holds up the
+    command producing output. Messages are delivered in order. When the
+    queue is full, policy decides what happens: "block" waits for room,
+    "dropoldest" discards the oldest queued message and "dropnewest"
+    discards the new one; dropped counts the discarded messages. stop()
+    delivers everything still queued and ends the writer thread, which is
+    started again by the next message.
+    """
+    policies = ("block", "dropoldest", "dropnewest")
+
+    def __init__(self, function, maxsize=1024, policy="block"):
+        if policy not in self.policies:
+            raise ValueError("Unknown backpressure policy '%s'" % policy)
+        self.function = function
+        self.maxsize = maxsize
+        self.policy = policy
+        self.queue = collections.deque()
+        self.condition = threading.Condition()
+        self.thread = None
+        self.busy = False
+        self.stopping = False
+        self.dropped = 0
+        self.errors = 0
+
+    def __call__(self, data=None):
+        with self.condition:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.write, name="spys-output-writer")
+                self.thread.daemon = True
+                self.thread.start()
+            while len(self.queue) >= self.maxsize:
+                if self.policy == "dropnewest":
+                    self.dropped += 1
+                    return False
+                elif self.policy == "dropoldest":
+                    self.queue.popleft()
+                    self.dropped += 1
+                else:
+                    # timed, so Ctrl-C still gets through while we wait
+                    self.condition.wait(0.1)
+            self.queue.append(data)
+            self.condition.notify_all()
+        return True
+
+    def write(self):
+        while True:
+            with self.condition:
+                while not self.queue and not self.stopping:
+                    self.condition.wait()
+                if not self.queue:
+                    self.thread = None
+                    self.condition.notify_all()
+                    return
+                data = self.queue.popleft()
+                self.busy = True
+                self.condition.notify_all()
+            try:
+                self.function(data)
+            except Exception:
+                self.errors += 1
+            with self.condition:
+                self.busy = False
+                self.condition.notify_all()
+
+    def drain(self):
+        """ Waits until every queued message has been delivered """
+        with self.condition:
+            while self.queue or self.busy:
+                self.condition.wait(0.1)
+
+    flush = drain
+
+    def stop(self):
+        with self.condition:
+            thread = self.thread
+            self.stopping = True
+            self.condition.notify_all()
+        if thread is not None:
+            thread.join()
+        with self.condition:
+            self.stopping = False
 
 
 class SPyIO(object):
@@ -36,11 +761,28 @@ class SPyIO(object):
     endpoint is requested, the default handler will be used.
     Endpoints are just functions! See cursesdemo for an example of this and 
     why it's useful.
+    Output endpoints can be registered as buffered, see BufferedEndpoint;
+    anything they hold back is flushed before every input() call. Slow
+    endpoints can be registered as threaded, see ThreadedEndpoint; input()
+    also waits for those to finish writing, so a prompt never lands ahead
+    of output. An
+    endpoint name can fan out to several filtered sinks, see addsink().
+    The shared dict is a SharedState, safe to update from commands running
+    on other threads; replace it with a SharedMemoryState to share it with
+    worker processes too.
+    Once deferoutput() is called, output from threads other than the one
+    that called it is queued and delivered by that thread at the next
+    flush() (before every input() call), so endpoints such as curses
+    windows are only ever driven from one thread. A thread that takes over
+    the prompt for a while, such as a server session's subshell, can call
+    deferoutput() as well and releaseoutput() when it is done.
     """
     def __init__(self, arg=None):
-        self.shared = {}
+        self.shared = SharedState()
         self._outendpoints = {0:self.defaultoutput}
         self._inendpoints = {0:self.defaultinput}        
+        self.outputqueue = None
+        self.outputthreads = None
 
     def defaultoutput(self, data=None):
         print data
@@ -53,15 +795,49 @@ class SPyIO(object):
             indata = raw_input()
         return indata
 
-    def output(self, data=None, endpoint=None):
-        if not endpoint:
-            self._outendpoints[0](data)
-        elif (endpoint in self._outendpoints) and callable(self._outendpoints[endpoint]):
-            self._outendpoints[endpoint](data)
+    def deferoutput(self):
+        """ Queues output from other threads for this one to deliver """
+        if self.outputqueue is None:
+            self.outputqueue = collections.deque()
+            self.outputthreads = set()
+        self.outputthreads.add(thread.get_ident())
+
+    def releaseoutput(self):
+        """ Stops delivering output on this thread, see deferoutput() """
+        if self.outputthreads is not None:
+            self.outputthreads.discard(thread.get_ident())
+
+    def output(self, data=None, endpoint=None, level=None):
+        if self.outputqueue is not None and thread.get_ident() not in self.outputthreads:
+            self.outputqueue.append((data, endpoint, level))
+            return
+        function = self._outendpoints.get(endpoint or 0)
+        if not callable(function):
+            function = self._outendpoints[0]
+        if isinstance(function, TeeEndpoint):
+            function(data, level)
         else:
-            self._outendpoints[0](data)
+            function(data)
     
+    def flush(self):
+        """
+        Delivers queued output from other threads and anything held back by
+        buffered endpoints, and waits for threaded endpoints to write theirs
+        """
+        queue = self.outputqueue
+        if queue and thread.get_ident() in self.outputthreads:
+            while True:
+                try:
+                    queued = queue.popleft()
+                except IndexError:
+                    break
+                self.output(*queued)
+        for function in self._outendpoints.values():
+            if isinstance(function, (BufferedEndpoint, ThreadedEndpoint, TeeEndpoint)):
+                function.flush()
+
     def input(self, data, endpoint=None):
+        self.flush()
         if not endpoint:
             return self._inendpoints[0](data)
         elif (endpoint in self._inendpoints) and callable(self._inendpoints[endpoint]):
@@ -69,18 +845,54 @@ class SPyIO(object):
         else:
             return self._inendpoints[0](data)
 
-    def registeroutput(self, name, function):
+    def wrapoutput(self, function, buffered=False, threaded=False, **policy):
+        if threaded:
+            function = ThreadedEndpoint(function, **dict((key, policy.pop(key))
+                                        for key in ('maxsize', 'policy') if key in policy))
+        if buffered:
+            function = BufferedEndpoint(function, **policy)
+        return function
+
+    def stopoutputs(self):
+        """ Flushes buffered endpoints and drains and stops threaded ones """
+        for function in self._outendpoints.values():
+            if hasattr(function, 'stop'):
+                function.stop()
+
+    def registeroutput(self, name, function, buffered=False, threaded=False, **policy):
+        """
+        Binds an output endpoint. With threaded set, it is called from a
+        writer thread through a ThreadedEndpoint (policy may hold maxsize
+        and policy). With buffered set, output is coalesced through a
+        BufferedEndpoint first (policy may hold size, interval and latest).
+        """
         if callable(function):
-            self._outendpoints[name] = function
+            self._outendpoints[name] = self.wrapoutput(function, buffered, threaded, **policy)
         else:
-            self._outendpoints[name] = defaultoutput
+            self._outendpoints[name] = self.defaultoutput
             return False
 
+    def addsink(self, name, function, level=None, predicate=None, **options):
+        """
+        Adds function as another sink of output endpoint name, which turns
+        into a TeeEndpoint (keeping any function already registered as its
+        first sink). The sink only receives messages of at least level for
+        which predicate(data, level) is true; options are the buffered,
+        threaded and policy arguments of registeroutput().
+        """
+        tee = self._outendpoints.get(name)
+        if not isinstance(tee, TeeEndpoint):
+            tee = TeeEndpoint()
+            if name in self._outendpoints:
+                tee.add(self._outendpoints[name])
+            self._outendpoints[name] = tee
+        tee.add(self.wrapoutput(function, **options), level, predicate)
+
     def registerinput(self, name, function):
         if callable(function):
             self._inendpoints[name] = function
         else:
-            self._inendpoints[name] = defaultinput
+            self._inendpoints[name] = self.defaultinput
             return False
 
 class SPyShell(SPyIO):
@@ -97,7 +909,17 @@ class SPyShell(SPyIO):
         @exec <string> - Executes python statement <string> in the current execution context
         @bind <keyword> <string> - Binds python function definiton in <string> to <keyword>
         ? [cmd]- Displays help message
+        @stats [on|off|reset|json [file]] - Per-command call counts, errors and latency percentiles
+        @profile [-s] [-n count] [-o file] <command line> - Runs a command line under the profiler
+        @codecache [clear] - Hit rates of the compiled @exec/@bind code and parsed line caches
+        @memo [cmd [ttl|off] [size]] - Caches the results of a pure command, or lists memoized commands
+        <command line> & - Runs a command line in the background, see @jobs, @wait [id] and @fg [id]
+        @isolate [cmd [timeout|off]] - Runs a plugin command in worker processes, with an optional timeout
     
+    Plugins that ship a <module>.manifest listing their command names (see calc.manifest) are
+    loaded lazily: @load binds stub commands and the module is only imported when one of them is
+    first called. Set lazyload to False on an instance to always import at @load time.
+
     In addition to dynamic plugin loading, callable objects can be bound to keywords in a SPyS instance via
     the setcmd method. Functions called by SPyS will be passed a single argument consisting of all 
     characters following the command executed on the SPyS command line. All parsing of command arguments 
@@ -111,13 +933,76 @@ class SPyShell(SPyIO):
         @bind hex lambda x:"%x" % int(x)
 
     Previously bound commands can be removed by passing None instead of a function to setcmd.
+    Commands that are pure functions of their arguments can be bound with memo=True (or marked
+    later with @memo), so repeated calls with the same arguments return the cached result.
+
+    Commands can be chained into pipelines, cmd1 args | cmd2 args, where records stream lazily
+    from stage to stage. A command may return an iterator (a generator, say) to produce many
+    records, and takes a 'stream' argument to consume the upstream iterator itself; otherwise
+    it is called once per upstream record, with the record appended to its arguments:
+        @exec self.setcmd('grep', lambda pattern, stream: (r for r in stream if pattern in str(r)))
 
     By default, any input that does not match a bound command is passed to the default(arg) method,
     which can be overridden to provide custom input handling.
     """
-    def __init__(self, arg=None):
+    def __init__(self, arg=None, parent=None, history=20, histfile=None):
         super(SPyShell, self).__init__(self)
 
+        # Subshells spawned with spawn(), or bound as commands and taking a
+        # 'parent' argument, are handed their parent directly.
+        if parent is not None:
+            self.callinginstance = parent
+        else:
+            self.callinginstance = self.findcaller()
+        self.shared = self.callinginstance.shared
+        self._outendpoints = self.callinginstance._outendpoints
+        self._inendpoints = self.callinginstance._inendpoints
+        self.outputqueue = getattr(self.callinginstance, 'outputqueue', None)
+        self.outputthreads = getattr(self.callinginstance, 'outputthreads', None)
+
+        self.__commands = {}
+        self.memos = {}     # keyword => (Command, LRUCache, ttl) of memoized commands
+        self.jobworkers = 4 # threads running background command lines
+        self.jobpool = None
+        self.backgroundjobs = collections.OrderedDict()
+        self.keptjobs = 100 # finished jobs kept for fg/wait, oldest dropped first
+        self.jobcount = 0
+        self.currentjob = threading.local()
+        self.isolated = {}  # keyword => timeout of commands run in worker processes
+        self.workercount = 2
+        self.workercalls = 100 # calls before a worker process is replaced
+        self.workers = None
+        self.__lastinput = RingBuffer(history)
+        self.__lastoutput = RingBuffer(history)
+        # optional persistent history, a path or a shared HistoryStore; subshells
+        # record into their parent's unless given their own
+        if histfile is None:
+            histfile = getattr(self.callinginstance, 'histstore', None)
+        elif not isinstance(histfile, HistoryStore):
+            histfile = HistoryStore(histfile)
+        self.histstore = histfile
+        self.__exitcmds = ['exit', 'quit']
+        self.__exec_ret = None
+        self.__runloop = True
+        self.compilescripts = False
+        self.lazyload = True
+        self.summarysize = 4096 # characters of streamed output kept for $o
+        self.__plugins = {}     # plugin name => Plugin.version bound in this shell
+        self.__watcher = None
+        # per-command latency metrics, off unless enabled with stats on
+        self.metrics = getattr(self.callinginstance, 'metrics', None)
+        # compiled exec/bind source, shared with subshells
+        self.codecache = getattr(self.callinginstance, 'codecache', None) or LRUCache(256)
+        # compiled script plans, private to the user running the shell
+        self.plancache = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+                                      "spys", "plans")
+		
+        self.settokenizer()
+        self.binddefault()
+        self.setprompt()
+
+    def findcaller(self):
+        """ Implicit parent lookup for shells created without one """
         # THIS IS DEEP VOODOO
         # We're inspecting the stack to get the calling frame,
         # so we can interact with the calling instance's .shared property
@@ -134,63 +1019,82 @@ class SPyShell(SPyIO):
         # The upshot of this whole thing is that the data in the .shared property
         # and the I/O endpoints transparently propagate into subshells invoked 
         # by the parent instance.
-        callstack = inspect.stack()
-        stacklen = len(callstack)
-        try:
-            myframe = callstack[stacklen - 2] # (len - 1) => this frame, (len - 2) => calling frame
-            self.callinginstance = myframe[0].f_locals['self']
-        except KeyError, IndexError:
-            self.callinginstance = self # PIME TARADOX
-        self.shared = self.callinginstance.shared
-        self._outendpoints = self.callinginstance._outendpoints
-        self._inendpoints = self.callinginstance._inendpoints
+        #
+        # Frames are walked directly rather than through inspect.stack(),
+        # which would read source context for every frame on the way.
+        frame = sys._getframe(1)
+        while frame.f_back is not None and frame.f_back.f_back is not None:
+            frame = frame.f_back # stop on the frame called from the outermost one
+        caller = frame.f_locals.get('self')
+        if isinstance(caller, SPyIO):
+            return caller
+        return self # PIME TARADOX
 
-        self.__commands = {}
-        self.__lastinput = FixedStack(20)
-        self.__lastoutput = FixedStack(20)
-        self.__exitcmds = ['exit', 'quit']
-        self.__exec_ret = None
-        self.__runloop = True
-		
-        self.binddefault()
-        self.setprompt()
+    def spawn(self, cls=None, *args, **kwargs):
+        """
+        Creates a subshell of class cls (SPyShell by default) sharing this
+        shell's shared dict and I/O endpoints, without the stack lookup.
+        """
+        return (cls or SPyShell)(parent=self, *args, **kwargs)
 
     def error(self, message, exception=None):
-        self.output(message, "error")
+        self.output(message, "error", ERROR)
         if exception:
-            self.output(traceback.format_exc(exception), "error")
+            self.output(traceback.format_exc(exception), "error", ERROR)
         return None
 
     def binddefault(self):
         ''' Default command bindings '''
         self.setcmd('$i', self.popinput)
         self.setcmd('$o', self.popoutput)
+        self.setcmd('history', self.searchhistory)
         self.setcmd('load', self.loadmodule)
+        self.setcmd('plugins', self.pluginstats)
+        self.setcmd('watch', self.watchplugins)
         self.setcmd('exec', self.execute)
         self.setcmd('bind', self.bindfn)
         self.setcmd('script', self.script)                    
+        self.setcmd('plan', self.runplan)
         self.setcmd('run', self.call)
         self.setcmd('prompt', self.setprompt)
         self.setcmd('?', self.help)
         self.setcmd('print', self.printio, "prints string literal")
+        self.setcmd('stats', self.stats)
+        self.setcmd('profile', self.profile)
+        self.setcmd('codecache', self.codecachestats)
+        self.setcmd('memo', self.memocommand)
+        self.setcmd('jobs', self.listjobs)
+        self.setcmd('wait', self.waitjobs)
+        self.setcmd('fg', self.foreground)
+        self.setcmd('cancel', self.canceljob)
+        self.setcmd('isolate', self.isolatecommand)
 
     def help(self, name=None, *args):
         '''displays command help'''
         if not name:
-            return "? <command> - Displays command help, if available\nAvailable commands: %s" % ", ".join(sorted(self.__commands.keys()))    
-        elif name in self.__commands and self.__commands[name].__doc__:
-            return "%s - %s" % (name, self.__commands[name].__doc__)
+            return self.listcommands()
+        elif name in self.__commands and self.__commands[name].fn.__doc__:
+            return "%s - %s" % (name, self.__commands[name].fn.__doc__)
         elif name not in self.__commands:
             return "%s is unbound" % name
         else:
             return "No help for %s" % name
 
+    def listcommands(self, width=20):
+        """ Streams the command list, width commands per chunk """
+        yield "? <command> - Displays command help, if available\nAvailable commands:"
+        names = sorted(self.__commands)
+        for index in xrange(0, len(names), width):
+            yield ", ".join(names[index:index + width])
+
     def printio(self, *args):
         for arg in args:
             self.output(str(arg))
 
     def script(self, filename, silent=False, *args):
         '''Executes file line-by-line in spys environment'''
+        if self.compilescripts:
+            return self.runplan(filename, silent)
         try:
             file = open(filename)
         except Exception, e:
@@ -201,15 +1105,122 @@ class SPyShell(SPyIO):
                 line = line.rstrip()
                 if not silent:
                     self.output(line)
-                self.handle(line)
+                drain(self.handle(line))
         except:
             return "Error reading input file"
 
-    def setcmd(self, keyword, fn, help=None):
+    def planfile(self, filename):
+        """ Path of the cached plan for a script """
+        key = hashlib.sha1(os.path.abspath(filename)).hexdigest()
+        return os.path.join(self.plancache, key + ".plan")
+
+    def plandir(self):
+        """
+        Creates the plan cache directory if needed and returns it. Plan
+        records are run as they are read, so a directory that is not owned
+        by this user, or that others can write to, raises OSError.
+        """
+        if not os.path.isdir(self.plancache):
+            os.makedirs(self.plancache, 0700)
+        info = os.lstat(self.plancache) # a symlink is refused, not followed
+        if info.st_uid != os.getuid() or not stat.S_ISDIR(info.st_mode):
+            raise OSError(errno.EPERM, "Plan cache %s is not a directory owned by this user" % self.plancache)
+        if info.st_mode & 0077:
+            os.chmod(self.plancache, 0700)
+        return self.plancache
+
+    def planrecord(self, line):
+        """ (line, args) plan record for a script line; args is None for lines left to handle() """
+        try:
+            args = tuple(split(line))
+        except ValueError:
+            args = None  # let handle() report the parse error at run time
+        if args and '|' in args and len(splitpipeline(line)) > 1:
+            args = None  # pipelines go through handle()
+        elif '&' in line and splitbackground(line) is not None:
+            args = None  # and so do background jobs
+        return (line, args)
+
+    def readplan(self, filename):
+        """
+        Yields (line, args) records from the cached plan for filename, or
+        from the script itself if the plan is missing or stale. Fresh
+        plans are written to the cache as the script is read, so neither
+        path holds more than one line in memory.
+        """
+        stat = os.stat(filename)
+        header = (PLAN_VERSION, os.path.abspath(filename), stat.st_mtime, stat.st_size)
+        try:
+            self.plandir()
+        except OSError, e:
+            self.error("Not caching script plans: %s" % e)
+            for line in open(filename):
+                yield self.planrecord(line.rstrip())
+            return
+        planpath = self.planfile(filename)
+        try:
+            plan = open(planpath, "rb")
+        except IOError:
+            plan = None
+        if plan:
+            try:
+                try:
+                    current = marshal.load(plan) == header
+                except (EOFError, ValueError, TypeError):
+                    current = False
+                # plans are renamed into place once complete, so EOF is the end
+                while current:
+                    try:
+                        record = marshal.load(plan)
+                    except EOFError:
+                        return
+                    yield record
+            finally:
+                plan.close()
+
+        (fd, tmppath) = tempfile.mkstemp(dir=self.plancache)
+        plan = os.fdopen(fd, "wb")
+        try:
+            marshal.dump(header, plan)
+            for line in open(filename):
+                record = self.planrecord(line.rstrip())
+                marshal.dump(record, plan)
+                yield record
+            plan.close()
+            os.rename(tmppath, planpath)
+        finally:
+            if not plan.closed:
+                plan.close()
+            if os.path.exists(tmppath):
+                os.remove(tmppath)
+
+    def runplan(self, filename, silent=False, *args):
+        '''Executes file from a compiled, cached plan'''
+        try:
+            for (line, args) in self.readplan(filename):
+                if not silent:
+                    self.output(line)
+                if args is None:
+                    drain(self.handle(line))
+                else:
+                    drain(self.dispatch(args, line))
+        except (IOError, OSError), e:
+            self.error("Could not open input file", e)
+        except:
+            return "Error reading input file"
+
+    def setcmd(self, keyword, fn, help=None, memo=False, ttl=None, size=128):
+        """
+        Binds fn to keyword, or unbinds keyword if fn is None. With memo
+        set, fn is treated as a pure function of its arguments, see
+        memoize(). Rebinding a keyword drops any results memoized for it.
+        """
+        self.memos.pop(keyword, None)
+        self.isolated.pop(keyword, None)
         if keyword and not fn:
             try:
                 del(self.__commands[keyword])
-            except IndexError:
+            except KeyError:
                 pass
         elif keyword and fn:
             if not __doc__ and help:
@@ -217,34 +1228,256 @@ class SPyShell(SPyIO):
                     fn.__doc__ = help
                 except:
                     pass
-            self.__commands[keyword] = fn
+            self.__commands[keyword] = Command(keyword, fn)
+            if memo:
+                self.memoize(keyword, ttl, size)
+
+    def bindexport(self, keyword, fn):
+        """
+        Binds a plugin export like setcmd(), but keeps the memo and
+        isolation settings of the command it replaces: a manifest stub, or
+        an earlier version of the plugin, whose memoized results are
+        dropped.
+        """
+        memo = self.memos.get(keyword)
+        isolated = keyword in self.isolated
+        timeout = self.isolated.get(keyword)
+        self.setcmd(keyword, fn)
+        if memo is not None:
+            (command, cache, ttl) = memo
+            if not isinstance(command.fn, LazyCommand):
+                cache = LRUCache(cache.size)
+            self.memos[keyword] = (self.__commands[keyword], cache, ttl)
+        if isolated:
+            self.isolated[keyword] = timeout
+
+    def memoize(self, keyword, ttl=None, size=128):
+        """
+        Caches the results of the command bound to keyword in an LRU of
+        size entries, keyed by its argument tuple, for ttl seconds (for
+        good if ttl is None). Streamed results and errors are not cached.
+        """
+        command = self.__commands.get(keyword)
+        if command is None:
+            return False
+        self.memos[keyword] = (command, LRUCache(size), ttl)
+        return True
+
+    def memocall(self, command, args):
+        """ Calls command through its memo cache """
+        (bound, cache, ttl) = self.memos[command.name]
+        if bound is not command:
+            # rebound behind setcmd()'s back, e.g. in a shared command table
+            del(self.memos[command.name])
+            return command(self, args)
+        args = tuple(args) # a list when the tokenizer runs uncached
+        entry = cache.get(args)
+        if entry is not None:
+            if ttl is None or entry[0] > time.time():
+                return entry[1]
+            cache.hits -= 1 # expired, counts as a miss
+            cache.misses += 1
+        if self.isolated and command.name in self.isolated:
+            result = self.isolatedcall(command, args)
+        else:
+            result = command(self, args)
+        if not isstream(result):
+            cache[args] = (ttl is not None and time.time() + ttl, result)
+        return result
+
+    def exportmodule(self, keyword):
+        """ Name of the plugin whose export, or manifest stub, is bound to keyword """
+        command = self.__commands.get(keyword)
+        if command is None:
+            return None
+        if isinstance(command.fn, LazyCommand):
+            return command.fn.module
+        for (name, plugin) in _plugins.items():
+            for export in plugin.exports or ():
+                if export[1] == keyword and export[2] is command.fn:
+                    return name
+        return None
+
+    def isolate(self, keyword, timeout=None):
+        """
+        Runs the plugin command bound to keyword in a pool of worker
+        processes with its plugin loaded, killing the worker if a call
+        takes longer than timeout seconds. Only plugin exports can be
+        isolated, as only they exist in the workers, and not subshells, as
+        workers have no input to read. See workers.WorkerPool.
+        """
+        module = self.exportmodule(keyword)
+        if module is None:
+            return False
+        if isinstance(self.__commands[keyword].fn, LazyCommand):
+            self.loadmodule(module, lazy=False) # see what the stub stands for
+        if self.__commands[keyword].parent:
+            return False
+        if self.workers is not None and module not in self.workers.modules:
+            self.workers.close() # started without this command's plugin
+            self.workers = None
+        self.isolated[keyword] = timeout
+        self.workerpool()
+        return True
+
+    def workerpool(self):
+        """ Worker processes for isolated commands, started on first use """
+        if self.workers is None:
+            import workers
+            modules = set(self.exportmodule(keyword) for keyword in self.isolated)
+            modules.discard(None)
+            self.workers = workers.WorkerPool(self.workercount, sorted(modules),
+                                              self.shared, self.workercalls)
+        return self.workers
+
+    def isolatedcall(self, command, args):
+        """ Runs command in a worker process, passing on what it output """
+        job = getattr(self.currentjob, 'job', None)
+        (result, output) = self.workerpool().call(command.name, args, self.isolated[command.name],
+                                                  job and job.cancelled)
+        for line in output:
+            self.output(line)
+        return result
+
+    def isolatecommand(self, name=None, timeout=None, *args):
+        '''runs a plugin command in worker processes: isolate <cmd> [timeout seconds|off], lists workers'''
+        if not name:
+            if not self.isolated:
+                return "No isolated commands"
+            return "\n".join(["%s: timeout %s" % (keyword, "none" if limit is None else "%ss" % limit)
+                              for (keyword, limit) in sorted(self.isolated.items())] +
+                             [self.workers.status() if self.workers is not None
+                              else "No worker processes running, started on the next call"])
+        if timeout == "off":
+            self.isolated.pop(name, None)
+            return "%s runs in-process again" % name
+        if timeout is not None:
+            timeout = float(timeout) or None
+        if name not in self.__commands:
+            return "%s is unbound" % name
+        if not self.isolate(name, timeout):
+            if self.__commands[name].parent:
+                return "%s is a subshell, which needs input that worker processes do not have" % name
+            return "%s is not a plugin command, only those run in worker processes" % name
+        return "%s runs in %d worker processes" % (name, self.workers.size)
+
+    def memocommand(self, name=None, ttl=None, size=128, *args):
+        '''memoizes a pure command: memo <cmd> [ttl seconds|off] [size], lists memoized commands'''
+        if not name:
+            if not self.memos:
+                return "No memoized commands"
+            return "\n".join("%s: %d/%d entries, %d hits, %d misses, ttl %s" % (
+                             keyword, len(cache), cache.size, cache.hits, cache.misses,
+                             "none" if ttl is None else "%ss" % ttl)
+                             for (keyword, (command, cache, ttl)) in sorted(self.memos.items()))
+        if ttl == "off":
+            self.memos.pop(name, None)
+            return "%s is no longer memoized" % name
+        if ttl is not None:
+            ttl = float(ttl) or None
+        if not self.memoize(name, ttl, int(size)):
+            return "%s is unbound" % name
+        return "Memoizing %s" % name
+
+    def sharecommands(self, shell):
+        """
+        Layers this shell's command table over shell's: the commands bound
+        so far (the built-ins) stay this shell's own, everything else is
+        looked up in, and bound into, shell's table.
+        """
+        self.__commands = CommandTable(self.__commands, shell.__commands)
+
+    def getcmd(self, keyword):
+        """ Returns the dispatch table entry bound to keyword, or None """
+        return self.__commands.get(keyword)
                 
+    def settokenizer(self, tokenizer=split, cachesize=256):
+        """
+        Selects the function used to split command lines into arguments
+        (shlex.split or any compatible callable), and the number of split
+        lines to keep in an LRU cache. A cachesize of 0 disables the cache.
+        """
+        if not cachesize:
+            self.tokenize = tokenizer
+            self.parsecache = None
+            return
+        cache = self.parsecache = LRUCache(cachesize)
+        def tokenize(line):
+            args = cache.get(line)
+            if args is None:
+                args = cache[line] = tuple(tokenizer(line))
+            return args
+        self.tokenize = tokenize
+
     def setprompt(self, input="spys> ", *args):
         '''sets SPyS prompt'''
         self.__prompt = input
 
+    def getprompt(self):
+        return self.__prompt
+
     def popinput(self, *args):
-        '''returns last input'''
+        '''returns last input, or the last saved input starting with [prefix]'''
         self.__lastinput.pop()        # pop first item because it's always going to be $i
+        if args and self.histstore is not None:
+            matches = self.histstore.search(" ".join(args), prefix=True, limit=1)
+            if matches:
+                return matches[0]
+            return "No history matching '%s'" % " ".join(args)
         return self.__lastinput.pop()
+
+    def searchhistory(self, text=None, limit=20, *args):
+        '''lists saved inputs containing [text], newest first'''
+        if self.histstore is None:
+            return "No history file"
+        if text:
+            entries = self.histstore.search(text, limit=int(limit))
+        else:
+            entries = []
+            for entry in self.histstore:
+                entries.append(entry)
+                if len(entries) >= int(limit):
+                    break
+        return "\n".join(reversed(entries))
     
     def popoutput(self, *args):
         '''returns last returned output'''
         return self.__lastoutput.pop()
     
+    def compilecode(self, source, mode="exec"):
+        """ Compiles source, reusing the code object if it was compiled before """
+        key = (source, mode)
+        code = self.codecache.get(key)
+        if code is None:
+            code = self.codecache[key] = compile(source, "<%s>" % mode, mode)
+        return code
+
+    def codecachestats(self, action=None, *args):
+        '''compiled code and parse cache statistics: codecache [clear]'''
+        caches = [("code", self.codecache)]
+        if self.parsecache is not None:
+            caches.append(("parse", self.parsecache))
+        if action == "clear":
+            for (name, cache) in caches:
+                cache.clear()
+                cache.hits = cache.misses = 0
+            return "Caches cleared"
+        return "\n".join("%s cache: %d/%d entries, %d hits, %d misses, %.1f%% hit rate" % (
+                         name, len(cache), cache.size, cache.hits, cache.misses, 100 * cache.ratio())
+                         for (name, cache) in caches)
+
     def execute(self, cmdstr, *args):
         '''executes python code'''
         try:
-            exec cmdstr
+            exec self.compilecode(cmdstr)
         except Exception, e:
             self.error("Execution failed", e)
             return None
 
     def bindfn(self, keyword, fn, *args):
         '''binds a function to a SPyS command'''
-        expr = "self.setcmd('%s', %s, '''(bound function <<%s>>)''')" % (keyword, fn, fn)
         try:
-            exec expr
+            self.setcmd(keyword, eval(self.compilecode(fn, "eval")), "(bound function <<%s>>)" % fn)
             return "<<%s>> bound to '%s'" % (fn, keyword)
         except Exception, e:
             self.error("Bind failed", e)
@@ -253,20 +1486,52 @@ class SPyShell(SPyIO):
     def call(self, cmdstr, *args):
         '''evaluates a SPyS command and executes the result'''
         result = self.handle(cmdstr)
+        if isstream(result):
+            result = "\n".join(str(chunk) for chunk in result if chunk is not None)
         self.output(result)
         return self.handle(result)
 
-    def loadmodule(self, input):
+    def loadmodule(self, input, lazy=None):
         '''loads a SPyS module'''
         commands = []
+        if lazy is None:
+            lazy = self.lazyload
+        if lazy and input not in sys.modules:
+            manifest = readmanifest(input)
+            if manifest is not None:
+                for (name, help) in manifest:
+                    self.setcmd(name, LazyCommand(self, input, name, help))
+                    commands.append(name)
+                return "%s new commands deferred from %s (%s)" % (len(commands), input, ', '.join(commands))
+        plugin = _plugins.get(input)
+        if plugin is None:
+            plugin = _plugins[input] = Plugin(input)
         try:
-            mod =__import__(input)
-            mod = reload(mod)
-            if 'spys_exports' in dir(mod):
-                exportlist = mod.spys_exports()
-                for export in exportlist:
-                    self.setcmd(export[1], export[2])
+            if input in sys.modules and not plugin.changed():
+                plugin.skipped += 1
+                mod = sys.modules[input]
+                if plugin.exports is not None and self.__plugins.get(input) == plugin.version:
+                    return "%s unchanged, %s commands already bound" % (input, len(plugin.exports))
+            else:
+                start = time.time()
+                if input in sys.modules:
+                    plugin.purgecompiled()
+                    mod = reload(sys.modules[input])
+                else:
+                    mod = __import__(input)
+                exports = None
+                if 'spys_exports' in dir(mod):
+                    exports = mod.spys_exports()
+                plugin.loaded(mod, exports, time.time() - start)
+            if plugin.exports is not None:
+                for export in plugin.exports:
+                    self.bindexport(export[1], export[2])
                     commands.append(export[1])
+                previous = self.__plugins.get(input)
+                self.__plugins[input] = plugin.version
+                if previous not in (None, plugin.version) and self.workers is not None and \
+                   input in self.workers.modules:
+                    self.workers.restart() # workers keep running the code they imported
                 msg = "%s new commands imported from %s (%s)" % (len(commands), mod.__name__, ', '.join(commands))
                 return msg
             else:
@@ -274,51 +1539,380 @@ class SPyShell(SPyIO):
         except ImportError, e:
             self.error("Load failed, couldn't import %s" % input, e)
 
+    def watchplugins(self, interval=2.0, *args):
+        '''reloads changed plugins every [interval] seconds in the background, "off" stops'''
+        if self.__watcher:
+            (stop, thread) = self.__watcher
+            stop.set()
+            thread.join()
+            self.__watcher = None
+        if interval == "off":
+            return "Plugin watcher stopped"
+        interval = float(interval)
+        stop = threading.Event()
+        def watch():
+            failed = {} # plugin => (mtime, size) of a source that failed to load, not retried
+            while not stop.wait(interval):
+                for name in list(self.__plugins):
+                    plugin = _plugins.get(name)
+                    if not plugin or not plugin.changed():
+                        continue
+                    try:
+                        stat = os.stat(plugin.path)
+                        stamp = (stat.st_mtime, stat.st_size)
+                    except OSError:
+                        continue
+                    if failed.get(name) == stamp:
+                        continue
+                    # the stamp only moves forward on success, so the next save is tried
+                    try:
+                        result = self.loadmodule(name, lazy=False)
+                    except Exception, e:
+                        self.error("Reloading %s failed, keeping the loaded version" % name, e)
+                        result = None
+                    if result is None:
+                        failed[name] = stamp
+                    else:
+                        failed.pop(name, None)
+                        self.output(result)
+        thread = threading.Thread(target=watch, name="spys-plugin-watcher")
+        thread.daemon = True
+        thread.start()
+        self.__watcher = (stop, thread)
+        return "Watching %s plugins every %ss" % (len(self.__plugins), interval)
+
+    def pluginstats(self, *args):
+        '''lists loaded plugins with reload counts and timings'''
+        lines = ["%-16s %7s %7s %7s %10s %10s" % ("plugin", "version", "reloads", "skipped", "last ms", "total ms")]
+        for name in sorted(self.__plugins):
+            plugin = _plugins[name]
+            lines.append("%-16s %7d %7d %7d %10.2f %10.2f" % (name, plugin.version, plugin.reloads,
+                         plugin.skipped, 1000 * plugin.lasttime, 1000 * plugin.totaltime))
+        return "\n".join(lines)
+
     def handle(self, input):
         if not input:
             return
-        args = shlex.split(input)
+        if '&' in input:
+            line = splitbackground(input)
+            if line is not None:
+                return self.background(line)
+        if '|' in input:
+            segments = splitpipeline(input)
+            if len(segments) > 1:
+                return self.pipeline(segments)
+        return self.dispatch(self.tokenize(input), input)
+
+    def background(self, line):
+        """
+        Runs a command line on the job thread pool. Its output, and a
+        notice when it finishes, are queued and delivered at the next prompt.
+        Its result is kept until fg or wait collects it; of the jobs nobody
+        collects, only the latest keptjobs finished ones are kept.
+        """
+        if not line:
+            return "Nothing to run in the background"
+        self.deferoutput()
+        if self.jobpool is None:
+            self.jobpool = ThreadPool(self.jobworkers)
+        self.jobcount += 1
+        job = Job(self.jobcount, line)
+        self.prunejobs()
+        self.backgroundjobs[job.id] = job
+        self.jobpool.apply_async(self.runjob, (job,))
+        return "[%d] %s" % (job.id, line)
+
+    def runjob(self, job):
+        job.start = time.time()
+        self.currentjob.job = job
+        try:
+            result = self.handle(job.line)
+            if isstream(result):
+                result = list(result) # produce it here, not on the REPL thread
+            job.result = result
+        except Exception, e:
+            job.failed = True
+            self.error("Untrapped exception in job [%d] '%s'" % (job.id, job.line), e)
+        self.currentjob.job = None
+        if job.cancelled.is_set():
+            job.failed = True
+        job.end = time.time()
+        job.done.set()
+        self.output("[%d] %s" % (job.id, job), "jobs", INFO)
+
+    def prunejobs(self):
+        """ Forgets the oldest finished jobs beyond keptjobs """
+        finished = [job for job in self.backgroundjobs.values() if job.done.is_set()]
+        for job in finished[:max(len(finished) - self.keptjobs, 0)]:
+            del(self.backgroundjobs[job.id])
+
+    def findjob(self, id=None):
+        if id is None:
+            return self.backgroundjobs.values()[-1] if self.backgroundjobs else None
+        return self.backgroundjobs.get(int(id))
+
+    def listjobs(self, *args):
+        '''lists background jobs'''
+        if not self.backgroundjobs:
+            return "No jobs"
+        return "\n".join("[%d] %s" % (id, job) for (id, job) in self.backgroundjobs.items())
+
+    def waitjobs(self, id=None, *args):
+        '''waits for background job [id], or all jobs, and returns (and forgets) the results'''
+        jobs = [self.findjob(id)] if id is not None else self.backgroundjobs.values()
+        if None in jobs:
+            return "No such job %s" % id
+        for job in jobs:
+            job.wait()
+        self.flush()
+        for job in jobs:
+            self.backgroundjobs.pop(job.id, None)
+        if id is not None:
+            return jobs[0].output()
+        return "\n".join("[%d] %s" % (job.id, job.output()) for job in jobs
+                         if job.output() is not None) or None
+
+    def canceljob(self, id=None, *args):
+        '''cancels background job [id], killing the worker process of an isolated command'''
+        job = self.findjob(id)
+        if job is None:
+            return "No such job %s" % (id or "")
+        if job.done.is_set():
+            return "[%d] already finished" % job.id
+        job.cancelled.set()
+        return "[%d] cancelling; only isolated commands can be stopped mid-call" % job.id
+
+    def foreground(self, id=None, *args):
+        '''waits for background job [id], the latest by default, and returns its result'''
+        job = self.findjob(id)
+        if job is None:
+            return "No such job %s" % (id or "")
+        job.wait()
+        self.flush()
+        self.backgroundjobs.pop(job.id, None)
+        if isinstance(job.result, list):
+            return iter(job.result)
+        return job.result
+
+    def pipeline(self, segments):
+        """
+        Runs 'cmd1 args | cmd2 args | ...' and returns an iterator over the
+        records coming out of the last stage. Records stream lazily: a stage
+        whose function takes a 'stream' argument is handed the upstream
+        iterator, any other command is called once per upstream record with
+        the record appended to its arguments. Stages returning an iterator
+        produce one record per item, other results are a single record.
+        """
+        stages = []
+        for segment in segments:
+            args = self.tokenize(segment)
+            if not args:
+                return "Empty pipeline stage"
+            command = self.__commands.get(args[0])
+            if command is None:
+                return "Unknown command '%s'" % args[0]
+            stages.append((command, tuple(args[1:])))
+        (command, args) = stages[0]
+        stream = self.stage(command, args)
+        for (command, args) in stages[1:]:
+            if command.stream:
+                stream = self.stage(command, args, stream)
+            else:
+                stream = self.mapstage(command, args, stream)
+        return stream
+
+    def stage(self, command, args, stream=None):
+        """
+        Records of one pipeline stage call. Errors, raised by the call or
+        while its result streams, are reported as dispatch() reports them
+        and end the stage's records.
+        """
+        try:
+            for record in records(command(self, args, stream)):
+                yield record
+        except Exception, e:
+            self.failed(command.name, args, e)
+
+    def mapstage(self, command, args, stream):
+        for record in stream:
+            for result in self.stage(command, args + (record,)):
+                yield result
+
+    def dispatch(self, args, input):
+        """ Runs an already tokenized command line """
+        if not args:
+            return
         cmd = args[0]
         cmdargs = args[1:]
-        if cmd in self.__commands.keys():
-            try:
-                if type(self.__commands[cmd]) == types.FunctionType and \
-                "instance" in inspect.getargspec(self.__commands[cmd])[0]:
-                    return self.__commands[cmd](instance=self, *cmdargs)
-                else:
-                    return self.__commands[cmd](*cmdargs)
-            except AttributeError or NameError, e:
-                self.error("Command '%s' failed" % cmd, e)
-            except ValueError or TypeError, e:
-                self.error("Bad argument(s) '%s' for '%s'" % (cmdargs, cmd), e)
-            except Exception, e:
-                self.error("Untrapped exception in '%s %s'" % (cmd, cmdargs), e)
-        else:
+        command = self.__commands.get(cmd)
+        if command is None:
             return self.default(input)
+        metrics = self.metrics
+        if metrics is not None:
+            start = time.time()
+        try:
+            if self.memos and cmd in self.memos:
+                result = self.memocall(command, cmdargs)
+            elif self.isolated and cmd in self.isolated:
+                result = self.isolatedcall(command, cmdargs)
+            else:
+                result = command(self, cmdargs)
+        except Exception, e:
+            self.failed(cmd, cmdargs, e)
+        else:
+            if metrics is not None:
+                metrics.record(cmd, time.time() - start)
+            return result
+        if metrics is not None:
+            metrics.record(cmd, time.time() - start, True)
  
+    def failed(self, cmd, cmdargs, e):
+        """ Reports the exception e raised by a command; call from the except clause """
+        if isinstance(e, (AttributeError, NameError)):
+            self.error("Command '%s' failed" % cmd, e)
+        elif isinstance(e, (ValueError, TypeError)):
+            self.error("Bad argument(s) '%s' for '%s'" % (list(cmdargs), cmd), e)
+        else:
+            self.error("Untrapped exception in '%s %s'" % (cmd, list(cmdargs)), e)
+
+    def stats(self, action=None, filename=None, *args):
+        '''per-command latency metrics: stats [on|off|reset|json [file]]'''
+        if action == "on":
+            if self.metrics is None:
+                self.metrics = Metrics()
+            return "Collecting command metrics"
+        elif action == "off":
+            self.metrics = None
+            return "Command metrics off"
+        elif self.metrics is None:
+            return "Command metrics are off, use 'stats on' to collect them"
+        elif action == "reset":
+            self.metrics = Metrics()
+        elif action == "json":
+            if not filename:
+                return self.metrics.dump()
+            with open(filename, "w") as dump:
+                dump.write(self.metrics.dump() + "\n")
+            return "Wrote metrics for %d commands to %s" % (len(self.metrics.commands), filename)
+        else:
+            return self.metrics.table()
+
+    def profile(self, *args):
+        '''profile [-s] [-n count] [-o file] <command line>: profiles one command line'''
+        sample = False
+        limit = 20
+        filename = None
+        args = list(args)
+        while args and args[0] in ("-s", "-n", "-o"):
+            option = args.pop(0)
+            if option == "-s":
+                sample = True
+            elif args and option == "-n":
+                limit = int(args.pop(0))
+            elif args:
+                filename = args.pop(0)
+        if not args:
+            return "Usage: profile [-s] [-n count] [-o file] <command line>"
+        # a single argument is run as is, so a quoted pipeline stays a pipeline
+        line = args[0] if len(args) == 1 else " ".join(pipes.quote(arg) for arg in args)
+
+        def run():
+            result = self.handle(line)
+            if isstream(result):
+                result = iter(list(result)) # produce streamed output while profiled
+            return result
+
+        # cProfile traces every call; -s samples the stack instead, for long runs
+        profiler = Sampler() if sample else cProfile.Profile()
+        start = time.time()
+        result = profiler.runcall(run)
+        elapsed = time.time() - start
+        if sample:
+            report = profiler.hotspots(limit)
+            if filename:
+                profiler.writefolded(filename)
+        else:
+            text = StringIO.StringIO()
+            pstats.Stats(profiler, stream=text).sort_stats("tottime").print_stats(limit)
+            report = text.getvalue().strip("\n")
+            if filename:
+                profiler.dump_stats(filename)
+        self.output("Profile of '%s', %.3fs:\n%s" % (line, elapsed, report), "profile", INFO)
+        if filename:
+            self.output("Wrote %s to %s" % ("folded stacks" if sample else "pstats", filename), "profile", INFO)
+        return result
+
     def rep(self, ret=None):
         try:
-            input = self.input(self.__prompt)
-            self.oninput(input)
-            self.__lastinput.append(input)
-            if input in self.__exitcmds:
-                self.stop()
+            self.evaluate(self.input(self.__prompt))
+        except Exception, e:
+            self.error("Untrapped exception in read-eval-print", e)
+
+    def evaluate(self, input):
+        """ Eval-print half of rep(), for loops that read input themselves """
+        self.oninput(input)
+        self.__lastinput.append(input)
+        if self.histstore is not None:
+            self.histstore.append(input)
+        if input in self.__exitcmds:
+            self.stop()
+        else:
+            result = self.handle(input)
+            if isstream(result):
+                self.__lastoutput.append(self.stream(result))
             else:
-                result = self.handle(input)
                 self.__lastoutput.append(result)
                 if result:
                     self.output(result)
-        except Exception, e:
-            self.error("Untrapped exception in read-eval-print", e)
+
+    def stream(self, chunks):
+        """
+        Outputs the chunks of a streamed result as they are produced, until
+        the iterator is exhausted or Ctrl-C interrupts it. Returns what $o
+        should remember: a lone chunk as is, otherwise a summary holding
+        at most summarysize characters of the output.
+        """
+        summary = []
+        size = count = 0
+        chunk = None
+        try:
+            for chunk in chunks:
+                count += 1
+                if chunk is not None:
+                    self.output(chunk)
+                    if size < self.summarysize:
+                        text = str(chunk)
+                        summary.append(text[:self.summarysize - size])
+                        size += len(text) + 1
+        except KeyboardInterrupt:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+            self.flush()
+            self.error("Interrupted after %d chunks" % count)
+        if count == 1:
+            return chunk
+        if size > self.summarysize:
+            summary.append("... (%d chunks)" % count)
+        return "\n".join(summary)
                 
     def start(self):
         self.__runloop = True
         while self.__runloop:
             ret = self.rep()
+        if self.callinginstance is self:
+            self.stopoutputs()  # endpoints are shared, only the top shell owns them
+        else:
+            self.flush()
         return ret
  
     def stop(self):
         self.__runloop = False
+        if self.jobpool is not None:
+            self.jobpool.close() # lets running jobs finish, takes no new ones
+            self.jobpool = None
+        if self.workers is not None:
+            self.workers.close()
+            self.workers = None
  
     def default(self, input):
         return "Unknown command"
@@ -327,6 +1921,93 @@ class SPyShell(SPyIO):
         pass
 
  
+# per-process state for batch() workers
+_batchmodules = []
+_batchshared = None
+_batchoutput = []
+
+def _batchinit(modules, shared=None):
+    """ Pool initializer: imports the plugins once per worker """
+    global _batchmodules, _batchshared
+    (_batchmodules, _batchshared) = (list(modules), shared)
+    shell = SPyShell()
+    for module in modules:
+        shell.loadmodule(module, lazy=False)
+
+def _batchshell():
+    """
+    Fresh shell for one script, so nothing a script binds or sets is seen
+    by the next one. The plugins are already imported, so loading them
+    only binds their cached exports.
+    """
+    shell = SPyShell()
+    if _batchshared is not None:
+        shell.shared = _batchshared
+    shell.registeroutput(0, lambda data=None: _batchoutput.append(str(data)))
+    for module in _batchmodules:
+        shell.loadmodule(module, lazy=False)
+    return shell
+
+def _batchrun(args):
+    (filename, echo) = args
+    del(_batchoutput[:])
+    start = time.time()
+    shell = _batchshell()
+    result = shell.script(filename, not echo)
+    shell.flush()
+    if result:
+        _batchoutput.append(result)
+    return (filename, "\n".join(_batchoutput), time.time() - start)
+
+def percentile(values, fraction):
+    """ Nearest-rank percentile of a sorted list """
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def batch(filenames, jobs=None, modules=(), echo=False, out=sys.stdout, shared=None):
+    """
+    Runs independent scripts across a pool of worker processes, each with
+    the same plugins loaded. Output is written per script in the order the
+    scripts were given, followed by a throughput and latency summary.
+    If shared is a SharedMemoryState, every worker shell attaches to it as
+    its shared dict.
+    """
+    pool = multiprocessing.Pool(jobs, _batchinit, (list(modules), shared))
+    latencies = []
+    start = time.time()
+    try:
+        for (filename, output, elapsed) in pool.imap(_batchrun, [(f, echo) for f in filenames]):
+            out.write("==> %s <==\n" % filename)
+            if output:
+                out.write(output + "\n")
+            latencies.append(elapsed)
+    finally:
+        pool.close()
+        pool.join()
+    wall = time.time() - start
+    latencies.sort()
+    out.write("%d scripts in %.3fs (%.1f scripts/s), latency p50 %.1fms p95 %.1fms max %.1fms\n" % (
+        len(latencies), wall, len(latencies) / max(wall, 1e-9), 1000 * percentile(latencies, 0.5),
+        1000 * percentile(latencies, 0.95), 1000 * percentile(latencies, 1.0)))
+
+
 if __name__ == "__main__":
-    s = SPyShell()
-    s.start()
+    import optparse
+    parser = optparse.OptionParser(usage="%prog [--batch [-j N] [-l module] [--echo] [--shared] script ...]")
+    parser.add_option("--batch", action="store_true", help="run scripts across a process pool")
+    parser.add_option("-j", "--jobs", type="int", help="worker processes (default: one per CPU)")
+    parser.add_option("-l", "--load", action="append", default=[], help="plugin to preload in each worker")
+    parser.add_option("--echo", action="store_true", help="echo script lines to the output")
+    parser.add_option("--shared", action="store_true", help="share one shared dict across all workers")
+    (options, filenames) = parser.parse_args()
+    if options.batch:
+        shared = SharedMemoryState() if options.shared else None
+        try:
+            batch(filenames, options.jobs, options.load, options.echo, shared=shared)
+        finally:
+            if shared is not None:
+                shared.unlink()
+    else:
+        s = SPyShell()
+        s.start()
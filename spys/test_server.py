@@ -0,0 +1,66 @@
+"""
+Tests for the multi-session server, talking to it over a Unix socket:
+
+    python -m unittest test_server
+"""
+import os, socket, tempfile, threading, time, unittest
+import server
+
+class ServerTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "spys.sock")
+        self.server = server.SPyServer()
+        self.server.listen(self.path)
+        self.thread = threading.Thread(target=self.server.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.loop.callthreadsafe(self.server.stop)
+        self.thread.join(5)
+        os.rmdir(self.directory)
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.path)
+        sock.settimeout(5)
+        self.addCleanup(sock.close)
+        return sock
+
+    def talk(self, sock, line=None, prompt="spys> "):
+        """ Sends line, returns everything received up to the next prompt """
+        if line is not None:
+            sock.sendall(line + "\n")
+        received = ""
+        while not received.endswith(prompt):
+            data = sock.recv(65536)
+            if not data:
+                break
+            received += data
+        return received
+
+    def test_subshell_after_background_job(self):
+        sock = self.connect()
+        self.talk(sock)
+        self.talk(sock, "print bg &")
+        self.talk(sock, "load calc")
+        self.talk(sock, "calc", "rpn> ")
+        self.assertIn("3.0", self.talk(sock, "1 2 + =", "rpn> "))
+        self.talk(sock, "exit")
+        self.assertEqual(self.talk(sock, "print after"), "after\nspys> ")
+
+    def test_background_output_during_subshell(self):
+        sock = self.connect()
+        self.talk(sock)
+        self.talk(sock, "bind nap \"lambda: __import__('time').sleep(0.3)\"")
+        self.talk(sock, "nap &")
+        self.talk(sock, "load calc")
+        self.talk(sock, "calc", "rpn> ")
+        time.sleep(0.5)
+        self.assertIn("[1] done", self.talk(sock, "1 =", "rpn> "))
+        self.talk(sock, "exit")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,55 @@
+"""
+Conformance tests for spys.split() against shlex.split():
+
+    python -m unittest test_split
+"""
+import random, shlex, unittest
+import spys
+
+CASES = [
+    "", "   ", "cmd", "cmd a b c", "  cmd\ta\r\nb  ", "a\x0bb\x0cc", "a\x1cb\x1fc",
+    "'single quoted' arg", '"double quoted" arg', "''", '""', "a '' b", 'a "" b',
+    "mixed'quo'ted\"wo\"rd", "esc\\ aped", "back\\\\slash", "\\'", '\\"',
+    '"a \\" b"', '"a \\\\ b"', '"a \\x b"', "'a \\ b'", '"it\'s"', "'say \"hi\"'",
+    'bind hex lambda x:"%x" % int(x)', "exec self.setcmd('hex', lambda x:x)",
+    "unterminated 'quote", 'unterminated "quote', "trailing\\", '"trailing\\',
+    '"trailing\\\\', '"esc\\"', "a\\\nb", "a # not a comment", "a|b & c; (d)",
+]
+
+def shlexsplit(line):
+    try:
+        return shlex.split(line)
+    except ValueError, e:
+        return ("ValueError", str(e))
+
+def spyssplit(line):
+    try:
+        return spys.split(line)
+    except ValueError, e:
+        return ("ValueError", str(e))
+
+
+class SplitTest(unittest.TestCase):
+    def check(self, line):
+        self.assertEqual(spyssplit(line), shlexsplit(line), "split(%r)" % line)
+
+    def test_cases(self):
+        for line in CASES:
+            self.check(line)
+
+    def test_fuzz(self):
+        rand = random.Random(0)
+        alphabet = "ab  \t'\"\\\n\x0b\x0c\x1c\x1d\x1e\x1f#|&;()"
+        for x in xrange(20000):
+            self.check("".join(rand.choice(alphabet) for y in range(rand.randint(0, 12))))
+
+    def test_cached_tokenizer(self):
+        shell = spys.SPyShell()
+        for line in CASES:
+            if not isinstance(shlexsplit(line), tuple):
+                self.assertEqual(list(shell.tokenize(line)), shlexsplit(line))
+                self.assertEqual(list(shell.tokenize(line)), shlexsplit(line)) # from the cache
+
+
+if __name__ == "__main__":
+    unittest.main()
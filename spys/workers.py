@@ -0,0 +1,228 @@
+"""
+Process-isolated command execution for SPyS. A WorkerPool keeps a few
+pre-forked worker processes, each with its own shell and the same plugins
+loaded, and runs commands in them one call at a time. A call that runs
+past its timeout or is cancelled gets its worker killed and replaced,
+which stops even CPU-bound code holding the GIL. Workers are also
+replaced after a number of calls, to bound memory growth in long-lived
+plugins.
+
+Commands are selected with SPyShell.isolate() or the isolate command;
+combined with a trailing & the REPL stays free while they run. Workers
+have no input: a command asking for some fails with NoInput, and
+subshells cannot be isolated at all.
+"""
+import multiprocessing, threading, time, traceback
+import spys
+
+class WorkerError(Exception):
+    """ A command raised in a worker; the message holds its traceback """
+
+
+class Cancelled(Exception):
+    """ A call was cancelled, or interrupted with Ctrl-C, and its worker killed """
+
+
+class CommandTimeout(Exception):
+    """ A call ran past its timeout and its worker was killed """
+
+
+class NoInput(BaseException):
+    """
+    Unwinds a command that asks a worker for input, which it has none of;
+    a BaseException, so REPL loops that trap errors do not spin on it
+    """
+
+def noinput(prompt=None):
+    """ Input endpoint of worker shells """
+    raise NoInput("commands running in worker processes cannot read input")
+
+
+def serve(conn, modules, shared):
+    """ Worker process main loop: runs (name, args) requests until None """
+    output = []
+    shell = spys.SPyShell()
+    shell.shared = shared
+    shell.registeroutput(0, lambda data=None: output.append(str(data)))
+    shell.registeroutput("error", lambda data=None: output.append(str(data)))
+    shell.registerinput(0, noinput)
+    for module in modules:
+        shell.loadmodule(module, lazy=False)
+    while True:
+        try:
+            request = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            break
+        if request is None:
+            break
+        (name, args) = request
+        del(output[:])
+        command = shell.getcmd(name)
+        try:
+            if command is None:
+                raise KeyError("'%s' is not bound in workers, only plugin commands are" % name)
+            result = command(shell, args)
+            streamed = spys.isstream(result)
+            if streamed:
+                result = list(result)
+            shell.flush()
+            reply = (True, result, output, streamed)
+        except (Exception, NoInput):
+            reply = (False, traceback.format_exc(), output, False)
+        try:
+            conn.send(reply)
+        except Exception:
+            # results that do not pickle come back as their text
+            conn.send((reply[0], str(reply[1]), output, False))
+
+
+class Worker(object):
+    """ One worker process and the parent's end of its pipe """
+    def __init__(self, modules, shared):
+        (self.conn, child) = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=serve, args=(child, modules, shared),
+                                               name="spys-worker")
+        self.process.daemon = True
+        self.process.start()
+        child.close()
+        self.calls = 0
+        self.running = None  # command line being run, for status()
+
+    def kill(self):
+        self.process.terminate()
+        self.process.join()
+        self.conn.close()
+
+    def retire(self):
+        """ Asks the worker to exit, killing it if it does not """
+        try:
+            self.conn.send(None)
+        except (IOError, EOFError):
+            pass
+        self.process.join(1.0)
+        if self.process.is_alive():
+            self.kill()
+        else:
+            self.conn.close()
+
+
+class WorkerPool(object):
+    """
+    size pre-forked workers with modules loaded. call() is safe to use
+    from several threads at once, such as background jobs; callers wait
+    for a free worker.
+    """
+    def __init__(self, size=2, modules=(), shared=None, maxcalls=100):
+        self.size = size
+        self.modules = list(modules)
+        self.shared = shared
+        self.maxcalls = maxcalls
+        self.condition = threading.Condition()
+        self.workers = []
+        self.idle = []
+        self.closed = False
+        for x in range(size):
+            self.spawn()
+
+    def spawn(self):
+        worker = Worker(self.modules, self.shared)
+        with self.condition:
+            if not self.closed:
+                self.workers.append(worker)
+                self.idle.append(worker)
+                self.condition.notify()
+                return
+        worker.retire()
+
+    def acquire(self):
+        with self.condition:
+            while not self.idle:
+                if self.closed:
+                    raise Cancelled("worker pool is closed")
+                self.condition.wait(0.1)
+            return self.idle.pop()
+
+    def release(self, worker, dead=False):
+        """ Returns worker to the pool, replacing it if it was killed or is used up """
+        with self.condition:
+            if not dead and worker.calls < self.maxcalls:
+                self.idle.append(worker)
+                self.condition.notify()
+                return
+            self.workers.remove(worker)
+        # retiring can take a second, so other callers are not held up meanwhile
+        if not dead:
+            worker.retire()
+        if not self.closed:
+            self.spawn()
+
+    def restart(self):
+        """
+        Replaces every worker, so they import the plugins again: idle
+        workers now, busy ones once their call returns.
+        """
+        with self.condition:
+            (idle, self.idle) = (self.idle, [])
+            for worker in self.workers:
+                worker.calls = self.maxcalls
+            for worker in idle:
+                self.workers.remove(worker)
+        for worker in idle:
+            worker.retire()
+            self.spawn()
+
+    def call(self, name, args, timeout=None, cancel=None):
+        """
+        Runs command name with args in a worker and returns (result,
+        output lines); streamed results come back as an iterator. Kills
+        the worker on timeout (CommandTimeout), when the cancel Event is
+        set or on Ctrl-C (Cancelled); raises WorkerError if the command
+        raised.
+        """
+        worker = self.acquire()
+        dead = True
+        try:
+            worker.running = " ".join((name,) + tuple(args))
+            worker.calls += 1
+            worker.conn.send((name, tuple(args)))
+            deadline = timeout and time.time() + timeout
+            # short polls keep Ctrl-C and cancellation working
+            while not worker.conn.poll(0.05):
+                if cancel is not None and cancel.is_set():
+                    raise Cancelled("'%s' cancelled" % worker.running)
+                if deadline and time.time() > deadline:
+                    raise CommandTimeout("'%s' timed out after %ss" % (worker.running, timeout))
+                if not worker.process.is_alive():
+                    raise WorkerError("worker exited with status %s running '%s'" % (
+                                      worker.process.exitcode, worker.running))
+            (ok, result, output, streamed) = worker.conn.recv()
+            dead = False
+        except KeyboardInterrupt:
+            raise Cancelled("'%s' interrupted" % worker.running)
+        finally:
+            worker.running = None
+            if dead:
+                worker.kill()
+            self.release(worker, dead)
+        if not ok:
+            raise WorkerError(result)
+        return (iter(result) if streamed else result, output)
+
+    def status(self):
+        lines = []
+        for (index, worker) in enumerate(list(self.workers)):
+            lines.append("worker %d: pid %s, %d/%d calls, %s" % (
+                         index, worker.process.pid, worker.calls, self.maxcalls,
+                         "running '%s'" % worker.running if worker.running else "idle"))
+        return "\n".join(lines)
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            workers = list(self.workers)
+            self.condition.notify_all()
+        for worker in workers:
+            if worker.running:
+                worker.kill()
+            else:
+                worker.retire()